@@ -2,17 +2,110 @@
 
 import math
 
+import numpy as np
 
-def populate_lines(coordinates):
-    """Populate lines list from text coordinates"""
-    points = []
 
-    for item in coordinates.split():
+def parse_coordinates(coordinates):
+    """Parse text coordinates into a (K, 2) array of longitude, latitude.
+
+    Vertices may carry an altitude, which is dropped. When every vertex has
+    the same number of values, the whole text is parsed in one pass;
+    otherwise each vertex is parsed on its own.
+    """
+    items = coordinates.split()
+    widths = set(item.count(',') + 1 for item in items)
+
+    if len(widths) == 1:
+        width = widths.pop()
+        values = coordinates.replace(',', ' ').split()
+
+        if width >= 2 and len(values) == width * len(items):
+            values = np.fromiter(map(float, values), dtype=np.float64, count=len(values))
+            return values.reshape(-1, width)[:, :2].copy()
+
+    vertices = []
+
+    for item in items:
         values = item.split(',')
-        points.append(Point(float(values[0]), float(values[1])))
+        vertices.append((float(values[0]), float(values[1])))
+
+    return np.array(vertices, dtype=np.float64).reshape(-1, 2)
+
+
+def format_coordinates(vertices):
+    """Format a (K, 2) vertex array as KML coordinates text"""
+    values = vertices.ravel().tolist()
+    return ' '.join(map('{0},{1},0'.format, values[0::2], values[1::2]))
+
+
+def format_segments(segments):
+    """KML coordinates text of every row of an (N, 4) segment array"""
+    values = segments.ravel().tolist()
+    return list(map('{0},{1},0 {2},{3},0'.format, values[0::4], values[1::4], values[2::4], values[3::4]))
+
+
+def segments_from_vertices(vertices):
+    """Turn a (K, 2) vertex array into a (K - 1, 4) array of segments"""
+    return np.hstack((vertices[:-1], vertices[1:]))
+
+
+def populate_segments(coordinates):
+    """Parse text coordinates straight into a (K - 1, 4) segment array"""
+    return segments_from_vertices(parse_coordinates(coordinates))
+
+
+# Trigger lines reach this far, in degrees, to either side of their street block
+TRIGGER_DISTANCE = 0.0002
+
+
+def trigger_segments(segments, distance):
+    """Trigger lines through the midpoints of an (N, 4) segment array.
+
+    Each trigger line is perpendicular to its segment and extends distance to
+    either side of the midpoint. The offset comes from the segment's direction
+    vector, so horizontal and vertical segments work; the ends are ordered as
+    in StreetBlock.find_line_through_midpoint. Zero length segments get a
+    degenerate trigger line at their midpoint.
+    """
+    lon1, lat1, lon2, lat2 = segments.T
+    mid_lon = (lon1 + lon2) / 2
+    mid_lat = (lat1 + lat2) / 2
+    run = lon2 - lon1
+    rise = lat2 - lat1
+
+    length = np.hypot(run, rise)
+    scale = np.divide(np.where(rise < 0, -distance, distance), length,
+                      out=np.zeros_like(length), where=length > 0)
+    offset_lon = -rise * scale
+    offset_lat = run * scale
 
-    for i in range(0, len(points) - 1):
-        yield Line(points[i], points[i + 1])
+    return np.column_stack((mid_lon + offset_lon, mid_lat + offset_lat,
+                            mid_lon - offset_lon, mid_lat - offset_lat))
+
+
+def populate_all_trigger_lines(street_blocks, distance):
+    """Populate trigger lines for every street block in one vectorized pass"""
+    street_blocks = list(street_blocks)
+    segments = [segments_from_vertices(block.vertices) for block in street_blocks]
+
+    if not segments:
+        return
+
+    triggers = trigger_segments(np.concatenate(segments), distance)
+    offsets = np.cumsum([len(block_segments) for block_segments in segments])[:-1]
+
+    for block, block_triggers in zip(street_blocks, np.split(triggers, offsets)):
+        block.trigger_segments = np.concatenate((block.trigger_segments, block_triggers))
+
+
+def lines_to_array(lines):
+    """Pack lines into an (N, 4) float64 array, without copying a LineArray"""
+    if isinstance(lines, LineArray):
+        return lines.segments
+
+    return np.array([(line.point1.longitude, line.point1.latitude,
+                      line.point2.longitude, line.point2.latitude) for line in lines],
+                    dtype=np.float64).reshape(-1, 4)
 
 
 class Color(object):
@@ -98,18 +191,48 @@ class ConversationRoute(object):
 
 
 class StreetBlock(object):
-    """A street block in Rock Island."""
+    """A street block in Rock Island.
+
+    The block's vertices and trigger lines are kept in float64 arrays; lines
+    and trigger_lines give Line views over them for code that walks segments.
+    """
 
     def __init__(self, name, coordinates):
         self.name = name
-        self.lines = list(populate_lines(coordinates))
-        self.trigger_lines = []
+        self.vertices = parse_coordinates(coordinates)
+        self.trigger_segments = np.zeros((0, 4), dtype=np.float64)
+        self.segment_text = None
+
+    @classmethod
+    def from_arrays(cls, name, vertices, trigger_segments):
+        """Create a street block from already parsed vertices and trigger lines"""
+        block = cls.__new__(cls)
+        block.name = name
+        block.vertices = vertices
+        block.trigger_segments = trigger_segments
+        block.segment_text = None
+        return block
+
+    @property
+    def lines(self):
+        """Segments of the block as Line views"""
+        return LineArray(segments_from_vertices(self.vertices))
+
+    def segment_coordinates(self):
+        """KML coordinates text of each segment, formatted once per block"""
+        if self.segment_text is None:
+            self.segment_text = format_segments(segments_from_vertices(self.vertices))
+        return self.segment_text
+
+    @property
+    def trigger_lines(self):
+        """Trigger lines of the block as Line views"""
+        return LineArray(self.trigger_segments)
 
     def populate_trigger_lines(self, distance):
         """Populate trigger lines for this street block"""
-        for line in self.lines:
-            self.trigger_lines.append(
-                self.find_line_through_midpoint(distance, line.midpoint(), -1 / line.slope()))
+        triggers = trigger_segments(segments_from_vertices(self.vertices), distance)
+        self.trigger_segments = np.concatenate((self.trigger_segments, triggers))
 
     def find_line_through_midpoint(self, distance, point, slope):
         """Find line through midpoint"""
@@ -122,6 +245,8 @@ class StreetBlock(object):
 class Point(object):
     """A single point on the globe"""
 
+    __slots__ = ('longitude', 'latitude')
+
     def __init__(self, longitude, latitude):
         self.longitude = longitude
         self.latitude = latitude
@@ -133,6 +258,8 @@ class Point(object):
 class Line(object):
     """A line connecting two points on the globe"""
 
+    __slots__ = ('point1', 'point2')
+
     def __init__(self, p1, p2):
         self.point1 = p1
         self.point2 = p2
@@ -151,3 +278,26 @@ class Line(object):
 
     def __str__(self):
         return '{0} {1}'.format(self.point1, self.point2)
+
+
+class LineArray(object):
+    """Sequence of Line views over an (N, 4) array of segments"""
+
+    __slots__ = ('segments',)
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LineArray(self.segments[index])
+
+        lon1, lat1, lon2, lat2 = self.segments[index].tolist()
+        return Line(Point(lon1, lat1), Point(lon2, lat2))
+
+    def __iter__(self):
+        for lon1, lat1, lon2, lat2 in self.segments.tolist():
+            yield Line(Point(lon1, lat1), Point(lon2, lat2))
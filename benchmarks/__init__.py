@@ -0,0 +1,6 @@
+"""Benchmarks for the conversation routes pipeline
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks
+"""
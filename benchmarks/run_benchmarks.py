@@ -0,0 +1,194 @@
+"""Time each stage of the pipeline on synthetic cities of growing size
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --save-baseline
+    python -m benchmarks.run_benchmarks --check
+
+Every stage is timed separately, taking the best of --repeats runs. The
+per-stage scaling exponent between consecutive sizes is printed as well:
+about 1 means linear in the city size, 2 means quadratic. Baseline timings
+are kept in baseline.json next to this file. --check fails when a stage
+gets slower than --tolerance times its baseline. Baselines are only
+comparable on the machine they were recorded on.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+import xml_utils as xu
+from RouteEntities import populate_all_trigger_lines, TRIGGER_DISTANCE
+from segment_engine import SegmentEngine
+from spatial_index import StreetBlockIndex
+from benchmarks.synthetic_kml import write_city_kml
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# (grid size, residents); residents grow with the number of blocks
+DEFAULT_SIZES = [(10, 25), (20, 100), (40, 400)]
+
+STAGES = ['parse_kml', 'read_street_blocks', 'populate_trigger_lines', 'build_block_index',
+          'read_conversation_data', 'create_walking_compilation', 'write_final_kml']
+
+
+def size_label(grid_size, residents):
+    return '{0}x{0}/{1}'.format(grid_size, residents)
+
+
+def run_pipeline(kml_path, output_path):
+    """Run the pipeline once, returning the seconds spent in each stage"""
+    timings = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    # The readers report progress on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        doc = timed('parse_kml', lambda: xu.DocumentIndex(etree.parse(kml_path)))
+        street_blocks = timed('read_street_blocks', lambda: list(xu.read_street_blocks(doc)))
+        timed('populate_trigger_lines', populate_all_trigger_lines, street_blocks, TRIGGER_DISTANCE)
+        block_index = timed('build_block_index',
+                            lambda: SegmentEngine(street_blocks, StreetBlockIndex(street_blocks)))
+        conversation_data = timed('read_conversation_data',
+                                  lambda: list(xu.read_conversation_data(doc, street_blocks, block_index)))
+
+        document = etree.Element('Document')
+        compilations_folder = xu.create_folder(document, 'COMPILATIONS')
+        timed('create_walking_compilation', xu.create_walking_compilation, document, compilations_folder,
+              conversation_data, xu.create_color_dict())
+
+        timed('write_final_kml', xu.write_final_kml, output_path, conversation_data, datetime.date(2016, 11, 8))
+
+    return timings
+
+
+def benchmark_size(grid_size, residents, repeats, work_dir):
+    """Best time of each stage over repeats runs on one synthetic city"""
+    kml_path = os.path.join(work_dir, 'mappings_{0}_{1}.kml'.format(grid_size, residents))
+    output_path = os.path.join(work_dir, 'final_output.kml')
+    write_city_kml(kml_path, grid_size, residents)
+
+    best = {}
+    for _ in range(repeats):
+        for stage, seconds in run_pipeline(kml_path, output_path).items():
+            best[stage] = min(seconds, best.get(stage, seconds))
+
+    best['total'] = sum(best[stage] for stage in STAGES)
+    return best
+
+
+def print_results(sizes, results):
+    columns = [size_label(*size) for size in sizes]
+    print('{0:28}'.format('stage') + ''.join('{0:>16}'.format(column) for column in columns))
+
+    for stage in STAGES + ['total']:
+        print('{0:28}'.format(stage) + ''.join('{0:>15.4f}s'.format(results[column][stage]) for column in columns))
+
+
+def print_scaling(sizes, results):
+    """Log-log slope of each stage's time against the number of residents"""
+    if len(sizes) < 2:
+        return
+
+    print()
+    print('scaling exponent vs. residents')
+    pairs = list(zip(sizes, sizes[1:]))
+    print('{0:28}'.format('stage') + ''.join('{0:>22}'.format(size_label(*b) + ' vs ' + str(a[1]))
+                                             for a, b in pairs))
+
+    for stage in STAGES + ['total']:
+        row = '{0:28}'.format(stage)
+        for a, b in pairs:
+            before = results[size_label(*a)][stage]
+            after = results[size_label(*b)][stage]
+            if before > 0 and after > 0 and a[1] != b[1]:
+                row += '{0:>22.2f}'.format(math.log(after / before) / math.log(float(b[1]) / a[1]))
+            else:
+                row += '{0:>22}'.format('-')
+        print(row)
+
+
+def check_baseline(results, baseline, tolerance):
+    """Stages slower than tolerance times their baseline, as printable lines"""
+    regressions = []
+
+    for label, timings in sorted(results.items()):
+        for stage, seconds in sorted(timings.items()):
+            expected = baseline.get(label, {}).get(stage)
+            if expected and seconds > expected * tolerance:
+                regressions.append('{0} {1}: {2:.4f}s vs baseline {3:.4f}s'.format(label, stage, seconds, expected))
+
+    return regressions
+
+
+def parse_size(text):
+    grid_size, residents = text.split(',')
+    return int(grid_size), int(residents)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', dest='sizes', action='append', type=parse_size, metavar='GRID,RESIDENTS',
+                        help='city size to run; may be repeated (default: {0})'.format(
+                            ' '.join('{0},{1}'.format(*size) for size in DEFAULT_SIZES)))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='record these timings as the baseline')
+    parser.add_argument('--check', action='store_true', help='exit with an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed slowdown factor against the baseline (default: 1.5)')
+    args = parser.parse_args(argv)
+    sizes = args.sizes or DEFAULT_SIZES
+
+    work_dir = tempfile.mkdtemp(prefix='conversation_routes_bench_')
+    try:
+        results = {}
+        for grid_size, residents in sizes:
+            results[size_label(grid_size, residents)] = benchmark_size(grid_size, residents, args.repeats, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print_results(sizes, results)
+    print_scaling(sizes, results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            rounded = dict((label, dict((stage, round(seconds, 6)) for stage, seconds in timings.items()))
+                           for label, timings in results.items())
+            json.dump(rounded, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print()
+        print('Baseline written to ' + args.baseline)
+
+    if args.check:
+        with open(args.baseline) as baseline_file:
+            regressions = check_baseline(results, json.load(baseline_file), args.tolerance)
+
+        print()
+        if regressions:
+            print('Regressions against ' + args.baseline + ':')
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('No regressions against ' + args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
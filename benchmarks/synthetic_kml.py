@@ -0,0 +1,217 @@
+"""Synthetic mappings.kml generator
+
+Builds a rotated street grid of grid_size x grid_size intersections. Every
+grid edge becomes a STREETBLOCKS placemark, some of them bent. Residents are
+added under hdConversations with W and B folders holding coded GTD/GF
+folders, a wConsider folder, and sometimes Notes and a pass through folder.
+Their hand drawn paths wander along the grid with some jitter. The layout
+follows the Google Earth exports the pipeline reads, so every reader and
+writer path is exercised.
+"""
+
+import math
+import random
+
+from lxml import etree
+
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+GX_NAMESPACE = 'http://www.google.com/kml/ext/2.2'
+
+# Distance between neighbouring intersections, in degrees
+BLOCK_SPACING = 0.0015
+GRID_ANGLE = 0.05
+ORIGIN = (-90.6, 41.45)
+
+ROUTE_COLORS = {'red': 'ff0000ff',
+                'yellow': 'ff00ffff',
+                'green': 'ff00ff00',
+                'green2': 'ff06ff21',
+                'hypothetical': 'fffa6446',
+                'nontraditional': 'ffff00ff',
+                'unknown': 'ff123456',
+                'street': 'ff0000aa'}
+ROUTE_STYLES = ['red', 'yellow', 'green', 'green', 'green2', 'nontraditional', 'unknown', 'hypothetical']
+
+
+def kml_node(parent, tag, text=None, **attrib):
+    node = etree.SubElement(parent, '{' + KML_NAMESPACE + '}' + tag, **attrib)
+    if text is not None:
+        node.text = text
+    return node
+
+
+def grid_point(x, y):
+    """Longitude and latitude of grid position x, y"""
+    x *= BLOCK_SPACING
+    y *= BLOCK_SPACING
+    return (ORIGIN[0] + x * math.cos(GRID_ANGLE) - y * math.sin(GRID_ANGLE),
+            ORIGIN[1] + x * math.sin(GRID_ANGLE) + y * math.cos(GRID_ANGLE))
+
+
+def format_coordinates(points, altitude=True):
+    if altitude:
+        return ' '.join('{0!r},{1!r},0'.format(lon, lat) for lon, lat in points)
+    return ' '.join('{0!r},{1!r}'.format(lon, lat) for lon, lat in points)
+
+
+def append_styles(document):
+    for name, color in ROUTE_COLORS.items():
+        style = kml_node(document, 'Style', id='s_' + name)
+        line_style = kml_node(style, 'LineStyle')
+        kml_node(line_style, 'color', color)
+        kml_node(line_style, 'width', '2')
+
+    style = kml_node(document, 'Style', id='s_highlight')
+    line_style = kml_node(style, 'LineStyle')
+    kml_node(line_style, 'color', 'ffaaaaaa')
+    kml_node(line_style, 'width', '3')
+
+    for name in ROUTE_COLORS:
+        style_map = kml_node(document, 'StyleMap', id='m_' + name)
+        for key, url in (('normal', '#s_' + name), ('highlight', '#s_highlight')):
+            pair = kml_node(style_map, 'Pair')
+            kml_node(pair, 'key', key)
+            kml_node(pair, 'styleUrl', url)
+
+
+def append_street_blocks(document, grid_size, rnd):
+    folder = kml_node(document, 'Folder')
+    kml_node(folder, 'name', 'STREETBLOCKS 11/8/16')
+
+    edges = []
+    for x in range(grid_size):
+        for y in range(grid_size):
+            for dx, dy in ((1, 0), (0, 1)):
+                if x + dx < grid_size and y + dy < grid_size:
+                    edges.append(((x, y), (x + dx, y + dy)))
+
+    for i, (start, end) in enumerate(edges):
+        steps = rnd.choice([1, 1, 2, 4])
+        points = []
+        for step in range(steps + 1):
+            t = float(step) / steps
+            lon, lat = grid_point(start[0] + (end[0] - start[0]) * t, start[1] + (end[1] - start[1]) * t)
+            if 0 < step < steps:
+                lon += rnd.uniform(-3e-5, 3e-5)
+                lat += rnd.uniform(-3e-5, 3e-5)
+            points.append((lon, lat))
+
+        # Both placemark layouts create_street_block understands
+        placemark = kml_node(folder, 'Placemark')
+        kml_node(placemark, 'name', 'B{0}'.format(i))
+        if i % 3:
+            kml_node(placemark, 'visibility', '0')
+        kml_node(placemark, 'styleUrl', '#m_street')
+        line_string = kml_node(placemark, 'LineString')
+        kml_node(line_string, 'tessellate', '1')
+        kml_node(line_string, 'coordinates', '\n\t\t' + format_coordinates(points) + ' \n\t\t')
+
+
+def random_path(grid_size, rnd):
+    """Coordinate text of a path wandering along the grid"""
+    x, y = rnd.randrange(grid_size), rnd.randrange(grid_size)
+    points = []
+
+    for _ in range(rnd.randint(2, 8)):
+        if rnd.random() < .5:
+            next_x, next_y = min(grid_size - 1, max(0, x + rnd.choice([-2, -1, 1, 2]))), y
+        else:
+            next_x, next_y = x, min(grid_size - 1, max(0, y + rnd.choice([-2, -1, 1, 2])))
+
+        steps = rnd.randint(3, 12)
+        for step in range(steps):
+            t = float(step) / steps
+            lon, lat = grid_point(x + (next_x - x) * t, y + (next_y - y) * t)
+            points.append((lon + rnd.uniform(-4e-5, 4e-5), lat + rnd.uniform(-4e-5, 4e-5)))
+        x, y = next_x, next_y
+
+    return format_coordinates(points, rnd.random() < .7)
+
+
+def append_route(parent, style, grid_size, rnd):
+    placemark = kml_node(parent, 'Placemark')
+    kml_node(placemark, 'name', 'Path')
+    kml_node(placemark, 'styleUrl', '#m_' + style)
+    line_string = kml_node(placemark, 'LineString')
+    kml_node(line_string, 'tessellate', '1')
+    kml_node(line_string, 'coordinates', '\n' + random_path(grid_size, rnd) + '\n')
+
+
+def append_point(parent, name, style=None):
+    placemark = kml_node(parent, 'Placemark')
+    kml_node(placemark, 'name', name)
+    if style:
+        kml_node(placemark, 'styleUrl', '#m_' + style)
+    point = kml_node(placemark, 'Point')
+    kml_node(point, 'coordinates', '{0!r},{1!r},0'.format(*grid_point(1, 1)))
+
+
+def append_resident(parent, number, grid_size, rnd):
+    folder = kml_node(parent, 'Folder')
+    kml_node(folder, 'name', 'Resident {0}'.format(number))
+    kml_node(folder, 'description', 'WGTD?=Y eWN?={0}\nBGTD?=Y eBN?={1} GFW?=N'.format(
+        rnd.choice(['WNOS', 'WNSSS']), rnd.choice(['BNCRC', 'BNAAS'])))
+
+    for mode in ('W', 'B'):
+        mode_folder = kml_node(folder, 'Folder')
+        kml_node(mode_folder, 'name', mode)
+        for code in ('GTD', 'GF'):
+            if rnd.random() < .8:
+                coded_folder = kml_node(mode_folder, 'Folder')
+                kml_node(coded_folder, 'name', code + ' ' + mode)
+                for _ in range(rnd.randint(1, 5)):
+                    append_route(coded_folder, rnd.choice(ROUTE_STYLES), grid_size, rnd)
+
+    consider_folder = kml_node(folder, 'Folder')
+    kml_node(consider_folder, 'name', 'wConsider')
+    coded_folder = kml_node(consider_folder, 'Folder')
+    kml_node(coded_folder, 'name', rnd.choice(['wCw', 'wCB']))
+    append_route(coded_folder, 'hypothetical', grid_size, rnd)
+
+    if rnd.random() < .5:
+        notes_folder = kml_node(folder, 'Folder')
+        kml_node(notes_folder, 'name', 'Notes')
+        for i in range(2):
+            append_point(notes_folder, rnd.choice(['Avoided Intersection {0}', 'Note {0}']).format(i))
+
+    if rnd.random() < .5:
+        extra_folder = kml_node(folder, 'Folder')
+        kml_node(extra_folder, 'name', 'Extra')
+        append_point(extra_folder, 'x', rnd.choice(sorted(ROUTE_COLORS)))
+
+
+def create_city_kml(grid_size, residents, seed=1):
+    """KML tree of a synthetic city with grid_size^2 intersections and residents resident folders"""
+    rnd = random.Random(seed)
+    kml = etree.Element('{' + KML_NAMESPACE + '}kml', nsmap={None: KML_NAMESPACE, 'gx': GX_NAMESPACE})
+    document = kml_node(kml, 'Document')
+    kml_node(document, 'name', 'mappings.kml')
+
+    append_styles(document)
+    append_street_blocks(document, grid_size, rnd)
+
+    conversations_folder = kml_node(document, 'Folder')
+    kml_node(conversations_folder, 'name', 'hdConversations 2018')
+    for number in range(residents):
+        append_resident(conversations_folder, number, grid_size, rnd)
+
+    return kml
+
+
+def write_city_kml(output_path, grid_size, residents, seed=1):
+    """Write a synthetic mappings.kml"""
+    etree.ElementTree(create_city_kml(grid_size, residents, seed)).write(
+        output_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a synthetic mappings.kml')
+    parser.add_argument('output')
+    parser.add_argument('--grid-size', type=int, default=20)
+    parser.add_argument('--residents', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    write_city_kml(args.output, args.grid_size, args.residents, args.seed)
@@ -0,0 +1,89 @@
+"""On-disk cache of parsed street blocks and their trigger lines
+
+The street block layer rarely changes between runs, so its parsed vertices
+and trigger lines are saved to a .npz file. The file is keyed by a hash of
+every street block's name and coordinate text plus the trigger distance.
+When either changes, the key no longer matches and the cache is rebuilt.
+"""
+
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from RouteEntities import StreetBlock, populate_all_trigger_lines
+
+# Bump when the cached arrays change meaning, so old files are rebuilt
+CACHE_VERSION = 1
+
+
+def street_blocks_key(fields, distance):
+    """Hash of street block names and coordinate text, and the trigger distance"""
+    digest = hashlib.sha256()
+    digest.update('{0}\0{1!r}\0'.format(CACHE_VERSION, float(distance)).encode('utf-8'))
+
+    for name, coordinates in fields:
+        digest.update(('-' if name is None else '+' + name).encode('utf-8') + b'\0')
+        digest.update(coordinates.encode('utf-8') + b'\0')
+
+    return digest.hexdigest()
+
+
+def read_cache(path, key):
+    """Street blocks stored at path under key, or None if missing or stale"""
+    try:
+        with np.load(path) as data:
+            if str(data['key']) != key:
+                return None
+
+            names = data['names'].tolist()
+            has_names = data['has_names'].tolist()
+            vertex_offsets = data['vertex_offsets']
+            trigger_offsets = data['trigger_offsets']
+            vertices = np.split(data['vertices'], vertex_offsets)
+            triggers = np.split(data['trigger_segments'], trigger_offsets)
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        return None
+
+    return [StreetBlock.from_arrays(name if has_name else None, block_vertices, block_triggers)
+            for name, has_name, block_vertices, block_triggers in zip(names, has_names, vertices, triggers)]
+
+
+def write_cache(path, key, street_blocks):
+    """Store street blocks at path under key, replacing any older cache"""
+    vertices = [block.vertices for block in street_blocks]
+    triggers = [block.trigger_segments for block in street_blocks]
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as cache_file:
+        np.savez(cache_file,
+                 key=np.array(key),
+                 names=np.array([block.name or '' for block in street_blocks], dtype=np.str_),
+                 has_names=np.array([block.name is not None for block in street_blocks], dtype=bool),
+                 vertex_offsets=np.cumsum([len(v) for v in vertices], dtype=np.intp)[:-1],
+                 vertices=np.concatenate([np.zeros((0, 2))] + vertices),
+                 trigger_offsets=np.cumsum([len(t) for t in triggers], dtype=np.intp)[:-1],
+                 trigger_segments=np.concatenate([np.zeros((0, 4))] + triggers))
+    os.replace(temp_path, path)
+
+
+def load_street_blocks(fields, distance, path):
+    """Street blocks with trigger lines, from the cache at path when it is current.
+
+    fields are (name, coordinate text) pairs, as given by
+    xml_utils.read_street_block_fields. On a miss the blocks are built and
+    their trigger lines populated, and the cache is rewritten.
+    """
+    fields = list(fields)
+    key = street_blocks_key(fields, distance)
+
+    street_blocks = read_cache(path, key)
+    if street_blocks is not None:
+        print('Street blocks loaded from cache.')
+        return street_blocks
+
+    street_blocks = [StreetBlock(name, coordinates) for name, coordinates in fields]
+    populate_all_trigger_lines(street_blocks, distance)
+    write_cache(path, key, street_blocks)
+    return street_blocks
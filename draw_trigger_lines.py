@@ -1,34 +1,191 @@
 """Script to draw trigger lines for a given street blocks KML"""
 
 from __future__ import print_function
+import argparse
 from lxml import etree
 import xml_utils as xu
+import kml_stream
+from RouteEntities import populate_all_trigger_lines, TRIGGER_DISTANCE
+from spatial_index import StreetBlockIndex
+from segment_engine import SegmentEngine
+from parallel_matching import read_conversation_data_parallel
+from block_cache import load_street_blocks
+from match_store import ResidentMatchStore, read_conversation_data_incremental, street_block_layer_version
+from path_memo import PathMemo, DEFAULT_SIZE
+from path_simplification import SimplifyingMatcher, DEFAULT_TOLERANCE
+from profiling import RunProfiler
+from split_output import write_split_kml, DEFAULT_THREADS
 import datetime
 
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--stream', action='store_true',
+                    help='read mappings.kml incrementally instead of parsing it whole')
+parser.add_argument('--stream-output', action='store_true',
+                    help='write output KML incrementally instead of building it whole')
+parser.add_argument('--no-pretty-print', dest='pretty_print', action='store_false',
+                    help='write output KML without indentation')
+parser.add_argument('--kmz', action='store_true',
+                    help='write compressed .kmz files; implies --stream-output')
+parser.add_argument('--pipeline', action='store_true',
+                    help='write each resident as soon as it is read and matched, instead of reading all '
+                         'residents first; implies --stream-output')
+parser.add_argument('--split-output', action='store_true',
+                    help='write each resident and compilation branch to its own file, linked from the final '
+                         'output KML by NetworkLinks')
+parser.add_argument('--write-threads', type=int, default=DEFAULT_THREADS, metavar='N',
+                    help='with --split-output, write files in N threads (default: {0})'.format(DEFAULT_THREADS))
+parser.add_argument('--merge-block-lines', dest='merge_lines', action='store_true',
+                    help='write each street block as one LineString instead of one placemark per segment')
+parser.add_argument('--gradient-steps', type=int, default=0, metavar='N',
+                    help='add a compilation coloring each street block by its mean rating, in N colors')
+parser.add_argument('--workers', type=int, default=0,
+                    help='match resident routes in this many worker processes')
+parser.add_argument('--block-cache', metavar='PATH',
+                    help='cache parsed street blocks and trigger lines in PATH between runs')
+parser.add_argument('--match-store', metavar='PATH',
+                    help='keep route matches per resident in PATH and only match new or changed residents')
+parser.add_argument('--simplify-paths', metavar='TOLERANCE', type=float, nargs='?', const=DEFAULT_TOLERANCE,
+                    help='simplify hand drawn paths before matching, dropping vertices within TOLERANCE degrees '
+                         'of the simplified path (default: {0})'.format(DEFAULT_TOLERANCE))
+parser.add_argument('--verify-simplification', action='store_true',
+                    help='with --simplify-paths, also match every full path and report routes matched differently')
+parser.add_argument('--path-memo-size', type=int, default=DEFAULT_SIZE, metavar='N',
+                    help='remember the street blocks of the last N distinct paths, so copied routes are matched '
+                         'once (default: {0}; 0 disables)'.format(DEFAULT_SIZE))
+parser.add_argument('--profile', metavar='REPORT',
+                    help='write time, peak memory and matching counters per stage and resident to this JSON file')
+parser.add_argument('--cprofile', metavar='PATH', help='also dump cProfile stats of the whole run to PATH')
+args = parser.parse_args()
+
+if args.kmz or args.pipeline:
+    args.stream_output = True
+__output_extension__ = '.kmz' if args.kmz else '.kml'
+
+if args.gradient_steps and args.gradient_steps < 2:
+    parser.error('--gradient-steps needs at least 2 colors')
+if args.write_threads < 1:
+    parser.error('--write-threads needs at least 1 thread')
+if args.workers < 0:
+    parser.error('--workers cannot be negative')
+if args.workers and args.stream:
+    parser.error('--workers needs the parsed document and cannot be combined with --stream')
+if args.match_store and (args.stream or args.workers):
+    parser.error('--match-store cannot be combined with --stream or --workers')
+if args.simplify_paths is not None:
+    if args.workers or args.match_store:
+        parser.error('--simplify-paths cannot be combined with --workers or --match-store')
+    if not 0 <= args.simplify_paths < TRIGGER_DISTANCE:
+        parser.error('--simplify-paths tolerance must be below the trigger distance {0}'.format(TRIGGER_DISTANCE))
+if args.verify_simplification and args.simplify_paths is None:
+    parser.error('--verify-simplification needs --simplify-paths')
+
+__profiler__ = RunProfiler(trace_memory=bool(args.profile), profile_path=args.cprofile)
+__profiler__.start()
+
 # Pull in mappings.kml file
-doc = etree.parse('mappings.kml')
+if not args.stream:
+    with __profiler__.stage('parse_kml'):
+        # Walk the parsed document once for the folders and styles every reader needs
+        doc = xu.DocumentIndex(etree.parse('mappings.kml'))
+
+# Read street blocks from KML file, and initialize lines on every street block at once
+if args.block_cache:
+    with __profiler__.stage('load_street_blocks'):
+        if args.stream:
+            __street_block_fields__ = kml_stream.iter_street_block_fields('mappings.kml')
+        else:
+            __street_block_fields__ = xu.read_street_block_fields(doc)
+        __street_blocks__ = load_street_blocks(__street_block_fields__, TRIGGER_DISTANCE, args.block_cache)
+    print('Street blocks read.')
+    print('Trigger lines populated on street blocks.')
+else:
+    with __profiler__.stage('read_street_blocks'):
+        if args.stream:
+            __street_blocks__ = list(kml_stream.iter_street_blocks('mappings.kml'))
+        else:
+            __street_blocks__ = list(xu.read_street_blocks(doc))
+    print('Street blocks read.')
+
+    with __profiler__.stage('populate_trigger_lines'):
+        populate_all_trigger_lines(__street_blocks__, TRIGGER_DISTANCE)
+    print('Trigger lines populated on street blocks.')
+
+# Index trigger lines so each route is only tested against nearby blocks,
+# and pack them into arrays for batched crossing tests
+with __profiler__.stage('build_block_index'):
+    __block_index__ = SegmentEngine(__street_blocks__, StreetBlockIndex(__street_blocks__))
+print('Street block index built.')
 
-# Read street blocks from KML file
-__street_blocks__ = list(xu.read_street_blocks(doc))
-print('Street blocks read.')
+# Optionally simplify hand drawn paths before they are matched
+if args.simplify_paths is not None:
+    __simplifier__ = SimplifyingMatcher(__street_blocks__, __block_index__, args.simplify_paths,
+                                        args.verify_simplification)
+    __block_index__ = __simplifier__
 
-# Initialize lines on each street block
-for block in __street_blocks__:
-    block.populate_trigger_lines(0.0002)
-print('Trigger lines populated on street blocks.')
+# Match routes copied into several coded folders only once
+if args.path_memo_size > 0:
+    __block_index__ = PathMemo(__block_index__, args.path_memo_size)
 
 # Write out trigger line KML
-xu.write_trigger_lines_kml('trigger_lines.kml', __street_blocks__)
+with __profiler__.stage('write_trigger_lines_kml'):
+    xu.write_trigger_lines_kml('trigger_lines' + __output_extension__, __street_blocks__, args.stream_output,
+                               args.pretty_print)
 print('Trigger lines KML written.')
 
+
+def print_matching_summary():
+    if args.match_store:
+        print('Residents matched: {0}, reused: {1}.'.format(__match_store__.misses, __match_store__.hits))
+    if args.simplify_paths is not None:
+        print('Path simplification removed {0} of {1} route segments.'.format(__simplifier__.segments_removed,
+                                                                             __simplifier__.segments_read))
+        if args.verify_simplification:
+            print('Routes matched differently when simplified: {0}.'.format(__simplifier__.mismatches))
+    if args.path_memo_size > 0 and not args.workers:
+        print('Paths matched: {0}, repeated: {1}.'.format(__block_index__.misses, __block_index__.hits))
+    print('Hand drawn conversations read and street blocks assigned.')
+
+
 # Read in paths and color (i.e. rating)
-__all_conversation_data__ = list(xu.read_conversation_data(doc, __street_blocks__))
-print('Hand drawn conversations read and street blocks assigned.')
+with __profiler__.stage('read_conversation_data'):
+    if args.match_store:
+        __match_store__ = ResidentMatchStore(args.match_store, street_block_layer_version(__street_blocks__))
+        __conversation_data__ = read_conversation_data_incremental(doc, __street_blocks__, __match_store__,
+                                                                   __block_index__)
+    elif args.workers:
+        __conversation_data__ = read_conversation_data_parallel(doc, __street_blocks__, args.workers)
+    elif args.stream:
+        __conversation_data__ = kml_stream.iter_conversation_data('mappings.kml', __street_blocks__, __block_index__)
+    else:
+        __conversation_data__ = xu.read_conversation_data(doc, __street_blocks__, __block_index__)
+    __conversation_data__ = __profiler__.iter_residents(__conversation_data__)
+
+    # Pipelined, residents are read and matched while the output is written
+    if not args.pipeline:
+        __conversation_data__ = list(__conversation_data__)
+
+if not args.pipeline:
+    print_matching_summary()
 
 # Write out resident street blocks and compilations
 d = datetime.datetime.today()
-xu.write_final_kml('final_output_' + d.strftime("%d%b%Y") + '.kml', __all_conversation_data__, d)
+with __profiler__.stage('read_match_write' if args.pipeline else 'write_final_kml'):
+    __output_path__ = 'final_output_' + d.strftime("%d%b%Y") + __output_extension__
+    if args.split_output:
+        write_split_kml(__output_path__, __conversation_data__, d, args.pretty_print, args.merge_lines,
+                        args.gradient_steps, args.write_threads)
+    else:
+        xu.write_final_kml(__output_path__, __conversation_data__, d, args.stream_output, args.pretty_print,
+                           args.merge_lines, args.gradient_steps)
+
+if args.pipeline:
+    print_matching_summary()
 print('Python conversations and compilations written.')
 
+__profiler__.stop()
+if args.profile:
+    __profiler__.write_report(args.profile)
+    print('Profile report written to ' + args.profile + '.')
+
 
 # handle hypothetical better -> street blocks
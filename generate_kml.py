@@ -5,6 +5,7 @@ import csv
 from lxml import etree
 from RouteEntities import RouteStep
 from xml_utils import *
+from kml_stream import iter_folder_placemarks, has_name
 
 def parse_csv(file_path, routes_person, routes_comp):
     """Read CSV and populate person and compilation routes"""
@@ -65,13 +66,10 @@ def fill_in_route_steps(routes, person_folder, person, coordinates_dict):
 #  Read in street block mappings
 print("Reading street blocks ... ", end="")
 
-DOC_KML = etree.parse('doc.kml')
 NSMAP = {'kml': 'http://www.opengis.net/kml/2.2', 'gx' : 'http://www.google.com/kml/ext/2.2'}
 
-folder = DOC_KML.xpath("//kml:Folder[./kml:name = 'STREETBLOCKS 11/8/16']", namespaces = NSMAP)[0]
-
 coordinates_dict = {}
-for placemark in folder.xpath('.//kml:Placemark', namespaces=NSMAP):
+for placemark in iter_folder_placemarks('doc.kml', lambda folder: has_name(folder, 'STREETBLOCKS 11/8/16')):
     #print(placemark[0].text, placemark[3][1].text.strip())
     coordinates_dict[placemark[0].text] = placemark[3][1].text.strip()
 
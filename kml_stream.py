@@ -0,0 +1,124 @@
+"""Streaming readers for large KML inputs
+
+These mirror read_street_blocks and read_conversation_data in xml_utils, but
+walk the file with etree.iterparse. Placemarks and folders are handed out as
+their closing tags are parsed and are dropped from the tree once processed,
+so memory is bounded by the largest single resident folder instead of the
+whole document.
+
+Styles and StyleMaps are kept as they are parsed. As in Google Earth exports,
+they must appear before the hdConversations folder that uses them.
+"""
+
+from lxml import etree
+
+from xml_utils import get_kml_namespace, kml_tag, create_street_block, street_block_fields, cache_styles, \
+    cache_style_maps, read_resident_folder
+
+
+FOLDER = kml_tag('Folder')
+NAME = kml_tag('name')
+PLACEMARK = kml_tag('Placemark')
+STYLE = kml_tag('Style')
+STYLE_MAP = kml_tag('StyleMap')
+
+
+def has_name_prefix(folder, prefix):
+    """Whether a folder has a name starting with prefix"""
+    return any((name.text or '').startswith(prefix) for name in folder.iterchildren(NAME))
+
+
+def has_name(folder, name_text):
+    """Whether a folder has a name equal to name_text"""
+    return any(name.text == name_text for name in folder.iterchildren(NAME))
+
+
+def is_inside(element, folder_test):
+    """Whether any enclosing folder passes folder_test"""
+    return any(folder_test(folder) for folder in element.iterancestors(FOLDER))
+
+
+def discard(element):
+    """Free a processed element and unlink it from the tree"""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        parent.remove(element)
+
+
+def iter_folder_placemarks(source, folder_test):
+    """Yield placemarks of the first folder passing folder_test as they are parsed"""
+    for event, element in etree.iterparse(source, events=('end',), tag=(FOLDER, PLACEMARK)):
+        if element.tag == FOLDER and folder_test(element) and not is_inside(element, folder_test):
+            return
+
+        if element.tag == PLACEMARK and is_inside(element, folder_test):
+            yield element
+
+        discard(element)
+
+
+def iter_street_blocks(source):
+    """Yield street blocks from a KML file as their placemarks are parsed"""
+    def is_street_blocks_folder(folder):
+        return has_name_prefix(folder, 'STREETBLOCKS ')
+
+    for placemark in iter_folder_placemarks(source, is_street_blocks_folder):
+        yield create_street_block(placemark)
+
+
+def iter_street_block_fields(source):
+    """Yield the name and coordinate text of each street block as its placemark is parsed"""
+    def is_street_blocks_folder(folder):
+        return has_name_prefix(folder, 'STREETBLOCKS ')
+
+    for placemark in iter_folder_placemarks(source, is_street_blocks_folder):
+        yield street_block_fields(placemark)
+
+
+def iter_conversation_data(source, street_blocks, block_index=None, route_matches=None):
+    """Yield conversations and notes from a KML file as resident folders are parsed"""
+    namespace = get_kml_namespace()
+    style_dict = {}
+    style_map_dict = {}
+    style_nodes_dict = {}
+    pending_style_maps = []
+
+    def is_conversations_folder(folder):
+        return has_name_prefix(folder, 'hdConversations ')
+
+    tags = (STYLE, STYLE_MAP, FOLDER, PLACEMARK)
+    for event, element in etree.iterparse(source, events=('end',), tag=tags):
+        if element.tag == STYLE:
+            cache_styles([element], style_dict)
+            continue
+
+        if element.tag == STYLE_MAP:
+            pending_style_maps.append(element)
+            continue
+
+        if is_inside(element, is_conversations_folder):
+            parent = element.getparent()
+
+            # Anything below a resident folder is kept until the resident is read
+            if not is_conversations_folder(parent) or is_inside(parent, is_conversations_folder):
+                continue
+
+            if element.tag == FOLDER:
+                # A resident folder has closed
+                cache_style_maps(pending_style_maps, style_dict, style_map_dict, style_nodes_dict)
+                pending_style_maps = []
+
+                yield read_resident_folder(element, namespace, style_map_dict, street_blocks, style_nodes_dict,
+                                           block_index, route_matches)
+
+                # Unlink only; the conversation still holds pass through nodes and notes
+                parent.remove(element)
+            else:
+                discard(element)
+            continue
+
+        if element.tag == FOLDER and is_conversations_folder(element):
+            return
+
+        discard(element)
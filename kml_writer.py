@@ -0,0 +1,173 @@
+"""Incremental KML writing
+
+KmlStreamWriter writes a document to disk one subtree at a time instead of
+building the whole tree and serializing it at the end. Each subtree is built
+and serialized inside a skeleton of its real ancestors, with the same root
+namespaces, depth and indentation state. So the bytes written are the same as
+etree.tounicode(root, pretty_print=...) would give for the whole tree.
+
+libxml2 stops indenting inside any element that has text children, such as
+the tail of a node copied from an input document. A container holding such
+children has to be opened with mixed=True, because its start tag is written
+before its children are known.
+
+open_kml_output opens the file to write to. A .kmz path gets a deflated zip
+archive whose doc.kml entry is compressed as the text is written.
+"""
+
+import io
+import time
+import zipfile
+from contextlib import contextmanager
+
+from lxml import etree
+
+INDENT = '  '
+START_MARKER = '_chunk_start'
+END_MARKER = '_chunk_end'
+KMZ_ENTRY = 'doc.kml'
+
+
+@contextmanager
+def open_kml_output(output_path):
+    """Open a text file to write KML to, compressed into a KMZ if the path ends in .kmz"""
+    if not output_path.lower().endswith('.kmz'):
+        with open(output_path, 'w') as output:
+            yield output
+        return
+
+    entry_info = zipfile.ZipInfo(KMZ_ENTRY, time.localtime()[:6])
+    entry_info.compress_type = zipfile.ZIP_DEFLATED
+
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as kmz:
+        with kmz.open(entry_info, 'w') as entry:
+            with io.TextIOWrapper(entry, encoding='utf-8') as output:
+                yield output
+
+
+class KmlStreamWriter(object):
+    """Write a KML tree incrementally to an open text file"""
+
+    def __init__(self, output, root_tag, nsmap, pretty_print=True):
+        self.output = output
+        self.pretty_print = pretty_print
+
+        root = etree.Element(root_tag, nsmap=nsmap)
+        self.stack = [root]
+        self.start_tags = [etree.tounicode(root)[:-2] + '>']
+        self.formatted = [pretty_print]
+        self.mixed = [False]
+        self.started = [False]
+
+    @property
+    def container(self):
+        """Skeleton element of the innermost open container; build children here, then flush"""
+        return self.stack[-1]
+
+    def start(self, tag, mixed=False):
+        """Open a container element as a child of the current one"""
+        self.flush()
+        self.write_start_tag()
+
+        self.stack.append(etree.SubElement(self.container, tag))
+        self.start_tags.append('<' + tag + '>')
+        self.formatted.append(self.formatted[-1] and not mixed)
+        self.mixed.append(mixed)
+        self.started.append(False)
+        self.reset_container()
+
+    def write(self, elements):
+        """Append finished elements to the current container and write them out"""
+        for element in elements:
+            self.container.append(element)
+        self.flush()
+
+    def flush(self):
+        """Write out and drop every element built in the current container"""
+        container = self.container
+        children = [child for child in container]
+
+        if not children:
+            return
+
+        if self.formatted[-1] and any(child.tail for child in children):
+            raise ValueError('Elements with tails need a container opened with mixed=True')
+
+        self.write_start_tag()
+
+        container.insert(0, etree.Element(START_MARKER))
+        etree.SubElement(container, END_MARKER)
+        text = etree.tounicode(self.stack[0], pretty_print=self.pretty_print)
+
+        start = text.index('<' + START_MARKER + '/>') + len(START_MARKER) + 3
+        end = text.rindex('<' + END_MARKER + '/>')
+
+        if self.formatted[-1]:
+            # Drop the newline after the start marker and the indent before the end marker
+            start += 1
+            end -= len(self.indent(len(self.stack)))
+
+        self.output.write(text[start:end])
+
+        for child in list(container):
+            container.remove(child)
+        self.reset_container()
+
+    def end(self):
+        """Close the current container"""
+        self.flush()
+
+        level = len(self.stack) - 1
+        tag = self.container.tag
+        parent_formatted = len(self.stack) > 1 and self.formatted[-2]
+
+        if not self.started[-1]:
+            if parent_formatted:
+                self.output.write(self.indent(level))
+            self.output.write(self.start_tags[-1][:-1] + '/>')
+        else:
+            if self.formatted[-1]:
+                self.output.write(self.indent(level))
+            self.output.write('</' + tag + '>')
+
+        if parent_formatted or (level == 0 and self.pretty_print):
+            self.output.write('\n')
+
+        self.stack.pop()
+        self.start_tags.pop()
+        self.formatted.pop()
+        self.mixed.pop()
+        self.started.pop()
+
+        if self.stack:
+            self.container.remove(self.container[-1])
+
+    def close(self):
+        """Close every open container, including the root"""
+        while self.stack:
+            self.end()
+
+    def write_start_tag(self):
+        """Write the current container's start tag if it is still pending"""
+        if self.started[-1]:
+            return
+
+        level = len(self.stack) - 1
+        if level > 0 and self.formatted[-2]:
+            self.output.write(self.indent(level))
+
+        self.output.write(self.start_tags[-1])
+
+        if self.formatted[-1]:
+            self.output.write('\n')
+
+        self.started[-1] = True
+
+    def reset_container(self):
+        """Empty the skeleton container, keeping a text child if it is mixed"""
+        # The text child makes libxml2 stop indenting in the skeleton too
+        self.container.text = '\n' if self.mixed[-1] else None
+
+    def indent(self, level):
+        return INDENT * level
+
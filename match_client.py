@@ -0,0 +1,91 @@
+"""Command line client of the local match service (match_service.py)
+
+    python match_client.py "lon,lat lon,lat ..." ["lon,lat ..." ...]
+    python match_client.py --reload
+    python match_client.py --status
+
+Prints the street block names each route's coordinates cross, one route
+per line. Errors the service replies with are printed, with exit status 1.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+
+class MatchError(Exception):
+    """Error reply of the match service"""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class MatchClient(object):
+    """Send queries to a running match service"""
+
+    def __init__(self, url=DEFAULT_URL, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, path, data=None):
+        """JSON reply of the service; raises MatchError with the service's message on error replies"""
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        request = Request(self.url + path, body, {'Content-Type': 'application/json'})
+
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except HTTPError as error:
+            try:
+                message = json.loads(error.read().decode('utf-8'))['error']
+            except (ValueError, KeyError, TypeError):
+                message = error.reason
+            raise MatchError(error.code, message)
+
+    def match(self, coordinates_list):
+        """Street block names crossed by each coordinate text"""
+        return self.request('/match', {'coordinates': list(coordinates_list)})['blocks']
+
+    def reload(self):
+        return self.request('/reload', {})
+
+    def status(self):
+        return self.request('/status')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('coordinates', nargs='*', help='KML coordinate text of a route')
+    parser.add_argument('--url', default=DEFAULT_URL)
+    parser.add_argument('--reload', action='store_true', help='re-read the street blocks first')
+    parser.add_argument('--status', action='store_true', help='print the service status')
+    args = parser.parse_args(argv)
+
+    client = MatchClient(args.url)
+
+    try:
+        if args.reload:
+            print(json.dumps(client.reload()))
+
+        if args.coordinates:
+            for names in client.match(args.coordinates):
+                print(', '.join(str(name) for name in names))
+
+        if args.status:
+            print(json.dumps(client.status()))
+    except MatchError as error:
+        print('ERROR {0}: {1}'.format(error.status, error), file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
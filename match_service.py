@@ -0,0 +1,291 @@
+"""Local HTTP/JSON service matching drawn routes to street blocks
+
+    python match_service.py [--kml mappings.kml] [--port 8765]
+
+The street blocks of the KML are read and their trigger lines populated
+once, at start up, and kept indexed in memory. Each query then only costs
+the matching itself:
+
+    POST /match   {"coordinates": "lon,lat lon,lat ..."}  or  {"coordinates": [text, ...]}
+               -> {"blocks": [[block name, ...], ...], "layer": n}
+    POST /reload  re-read the street blocks from the KML -> {"street_blocks": count, "layer": n}
+    GET  /status  -> {"street_blocks": count, "layer": n, "queries": count, "batches": count}
+
+Queries arriving together are matched by one thread as a batch, in one
+pass of the matching engine over all their paths, against the block layer
+current when the batch starts. A reload builds the new layer aside and
+swaps it in, so queries are never answered from a half loaded layer; if
+the reload fails, the old layer stays. If matching a batch fails, its
+queries are matched one at a time, so a bad query only fails itself.
+match_client.py is a small client of the service.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import kml_stream
+from RouteEntities import TRIGGER_DISTANCE, LineArray, StreetBlock, populate_all_trigger_lines, populate_segments
+from block_cache import load_street_blocks
+from segment_engine import SegmentEngine
+from spatial_index import StreetBlockIndex
+
+# Longest a query waits for others to batch with, in seconds
+BATCH_WINDOW = 0.005
+MAX_BATCH = 256
+
+# Longest a query waits for its batch to be matched, in seconds
+QUERY_TIMEOUT = 60
+
+
+class BlockLayer(object):
+    """Street blocks of one load of the KML, indexed for matching"""
+
+    def __init__(self, street_blocks, version):
+        self.street_blocks = street_blocks
+        self.version = version
+        self.engine = SegmentEngine(street_blocks, StreetBlockIndex(street_blocks))
+
+    def match(self, paths):
+        """Names of the street blocks each path crosses, matched in one pass for all paths"""
+        crossed = self.engine.blocks_crossed_batch(paths)
+        return [[self.street_blocks[block_id].name for block_id in np.flatnonzero(path_crossed).tolist()]
+                for path_crossed in crossed]
+
+
+def read_paths(coordinates_list):
+    """Parse the coordinate texts of a query into paths"""
+    try:
+        segment_arrays = [populate_segments(coordinates) for coordinates in coordinates_list]
+    except (ValueError, IndexError):
+        raise ValueError('coordinates must be "lon,lat lon,lat ..." texts')
+
+    if not all(np.isfinite(segments).all() for segments in segment_arrays):
+        raise ValueError('coordinates must be finite numbers')
+
+    return [LineArray(segments) for segments in segment_arrays]
+
+
+def read_block_layer(kml_path, cache_path, version):
+    """Read the street blocks of kml_path, with their trigger lines, into a BlockLayer"""
+    fields = kml_stream.iter_street_block_fields(kml_path)
+
+    if cache_path:
+        street_blocks = load_street_blocks(fields, TRIGGER_DISTANCE, cache_path)
+    else:
+        street_blocks = [StreetBlock(name, coordinates) for name, coordinates in fields]
+        populate_all_trigger_lines(street_blocks, TRIGGER_DISTANCE)
+
+    return BlockLayer(street_blocks, version)
+
+
+class MatchService(object):
+    """The current block layer and the thread matching queries against it in batches"""
+
+    def __init__(self, kml_path, cache_path=None, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.kml_path = kml_path
+        self.cache_path = cache_path
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.layer = read_block_layer(kml_path, cache_path, 1)
+        self.reload_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.queries = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, name='match-batcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, coordinates_list):
+        """Queue the coordinate texts of one query; returns a Future of what match returns"""
+        future = Future()
+        self.requests.put((coordinates_list, future))
+        return future
+
+    def match(self, coordinates_list):
+        """Block names of each coordinate text, and the version of the layer they were matched against"""
+        return self.submit(coordinates_list).result(QUERY_TIMEOUT)
+
+    def reload(self):
+        """Re-read the street blocks, then swap the new layer in; on errors the old layer stays"""
+        with self.reload_lock:
+            self.layer = read_block_layer(self.kml_path, self.cache_path, self.layer.version + 1)
+        return self.layer
+
+    def next_batch(self):
+        """Queries waiting together, or None once stopped"""
+        request = self.requests.get()
+        if request is None:
+            return None
+
+        batch = [request]
+        deadline = time.monotonic() + self.batch_window
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if request is None:
+                # Answer this batch, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+
+            layer = self.layer
+            self.batches += 1
+
+            # The paths of all queries in the batch, and where each query's start
+            paths = []
+            queries = []
+
+            for coordinates_list, future in batch:
+                self.queries += 1
+                try:
+                    query_paths = read_paths(coordinates_list)
+                except ValueError as error:
+                    future.set_exception(error)
+                    continue
+
+                queries.append((future, len(paths), len(query_paths)))
+                paths.extend(query_paths)
+
+            try:
+                names = layer.match(paths)
+            except Exception:
+                # Match each query on its own, so only the failing ones get the error
+                for future, start, count in queries:
+                    try:
+                        future.set_result((layer.match(paths[start:start + count]), layer.version))
+                    except Exception as error:
+                        future.set_exception(error)
+                continue
+
+            for future, start, count in queries:
+                future.set_result((names[start:start + count], layer.version))
+
+    def status(self):
+        layer = self.layer
+        return {'street_blocks': len(layer.street_blocks), 'layer': layer.version,
+                'queries': self.queries, 'batches': self.batches}
+
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    """JSON endpoints of a MatchService, which the server carries as match_service"""
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.match_service.status())
+        else:
+            self.send_json(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        service = self.server.match_service
+
+        try:
+            request = self.read_json()
+
+            if self.path == '/match':
+                coordinates = request.get('coordinates')
+                coordinates_list = [coordinates] if isinstance(coordinates, str) else coordinates
+                if not isinstance(coordinates_list, list) or \
+                        not all(isinstance(text, str) for text in coordinates_list):
+                    raise ValueError('coordinates must be coordinate text or a list of coordinate texts')
+
+                names, layer = service.match(coordinates_list)
+                self.send_json(200, {'blocks': names, 'layer': layer})
+            elif self.path == '/reload':
+                try:
+                    layer = service.reload()
+                except Exception as error:
+                    self.send_json(500, {'error': 'Reload failed, keeping layer {0}: {1}'.format(
+                        service.layer.version, error)})
+                    return
+                self.send_json(200, {'street_blocks': len(layer.street_blocks), 'layer': layer.version})
+            else:
+                self.send_json(404, {'error': 'Unknown path ' + self.path})
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+        except FutureTimeoutError:
+            self.send_json(504, {'error': 'Timed out waiting for the match'})
+        except Exception as error:
+            self.send_json(500, {'error': '{0}: {1}'.format(type(error).__name__, error)})
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b'{}'
+        request = json.loads(body.decode('utf-8'))
+
+        if not isinstance(request, dict):
+            raise ValueError('Request body must be a JSON object')
+        return request
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(service, host='127.0.0.1', port=8765):
+    server = ThreadingHTTPServer((host, port), MatchRequestHandler)
+    server.daemon_threads = True
+    server.match_service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kml', default='mappings.kml', help='KML to read the street blocks from')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--block-cache', metavar='PATH',
+                        help='cache parsed street blocks and trigger lines in PATH between runs')
+    args = parser.parse_args(argv)
+
+    service = MatchService(args.kml, args.block_cache)
+    service.start()
+    server = create_server(service, args.host, args.port)
+    print('Matching against {0} street blocks on http://{1}:{2}/'.format(
+        len(service.layer.street_blocks), args.host, server.server_address[1]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
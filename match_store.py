@@ -0,0 +1,120 @@
+"""Incremental re-runs that only re-match changed residents
+
+The street blocks matched for each resident's routes are kept in a local
+JSON store. Each entry is keyed by a fingerprint of the resident folder's
+serialized XML, and the whole store by a version of the street block layer.
+On a rerun, unchanged residents reuse their stored matches through
+route_matches. Only new or edited residents are matched again. Everything
+else, including the compilations, is rebuilt as in a full run, so the output
+is the same.
+"""
+
+import hashlib
+import json
+import os
+
+from lxml import etree
+
+from RouteEntities import LineArray, populate_segments
+from xml_utils import get_kml_namespace, document_index, read_style_dicts, read_resident_folders, \
+    read_resident_folder, read_route_coordinates, find_overlapping_streetblocks
+
+# Bump when stored matches change meaning, so old stores are discarded
+STORE_VERSION = 1
+
+
+def street_block_layer_version(street_blocks):
+    """Hash of every street block's name, vertices and trigger lines"""
+    digest = hashlib.sha256(str(STORE_VERSION).encode('utf-8'))
+
+    for block in street_blocks:
+        digest.update(('-' if block.name is None else '+' + block.name).encode('utf-8') + b'\0')
+        digest.update(block.vertices.tobytes())
+        digest.update(block.trigger_segments.tobytes())
+
+    return digest.hexdigest()
+
+
+def resident_fingerprint(resident_folder):
+    """Hash of a resident folder's serialized XML"""
+    return hashlib.sha256(etree.tostring(resident_folder)).hexdigest()
+
+
+class ResidentMatchStore(object):
+    """Stored route -> street block id matches of each resident, by fingerprint"""
+
+    def __init__(self, path, layer_version):
+        self.path = path
+        self.layer_version = layer_version
+        self.residents = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(path):
+            with open(path) as store_file:
+                try:
+                    data = json.load(store_file)
+                except ValueError:
+                    data = {}
+
+            if data.get('layer_version') == layer_version:
+                self.residents = data.get('residents', {})
+
+    def get(self, fingerprint):
+        """Stored coordinates -> block ids of a resident, or None"""
+        matches = self.residents.get(fingerprint)
+
+        if matches is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(fingerprint)
+
+        return matches
+
+    def put(self, fingerprint, matches):
+        self.residents[fingerprint] = matches
+        self.used.add(fingerprint)
+
+    def save(self):
+        """Write the store, dropping residents not seen in this run"""
+        data = {'layer_version': self.layer_version,
+                'residents': dict((fingerprint, self.residents[fingerprint]) for fingerprint in self.used)}
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as store_file:
+            json.dump(data, store_file, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+def read_conversation_data_incremental(doc, street_blocks, store, block_index=None):
+    """Read in conversation routes and notes, matching only residents missing from store.
+
+    Yields the same conversations as xml_utils.read_conversation_data, in the
+    same order. The store is saved once every resident has been read.
+    """
+    namespace = get_kml_namespace()
+    doc = document_index(doc)
+    style_map_dict, style_nodes_dict = read_style_dicts(doc)
+    block_ids = dict((block, block_id) for block_id, block in enumerate(street_blocks))
+
+    for resident_folder in read_resident_folders(doc):
+        fingerprint = resident_fingerprint(resident_folder)
+        matches = store.get(fingerprint)
+
+        if matches is None:
+            matches = {}
+            for coordinates in read_route_coordinates(resident_folder):
+                lines = LineArray(populate_segments(coordinates))
+                matches[coordinates] = [block_ids[block] for block in
+                                        find_overlapping_streetblocks(street_blocks, lines, block_index)]
+            store.put(fingerprint, matches)
+
+        route_matches = dict((coordinates, [street_blocks[block_id] for block_id in matched])
+                             for coordinates, matched in matches.items())
+
+        yield read_resident_folder(resident_folder, namespace, style_map_dict, street_blocks, style_nodes_dict,
+                                   route_matches=route_matches)
+
+    store.save()
@@ -0,0 +1,63 @@
+"""Match hand drawn routes to street blocks across a process pool
+
+Residents are independent, so each resident's routes are matched in a worker
+process while the main process reads the KML. The street blocks are handed
+to every worker once, when the pool starts; tasks carry only coordinate
+text, and results come back as street block ids. Residents are still read
+one after another in document order, so the output does not depend on which
+worker finishes first.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+from RouteEntities import LineArray, populate_segments
+from segment_engine import SegmentEngine
+from spatial_index import StreetBlockIndex
+from xml_utils import get_kml_namespace, document_index, read_style_dicts, read_resident_folders, \
+    read_resident_folder, read_route_coordinates
+
+# Matching engine of a worker process, built once by init_worker
+worker_engine = None
+
+
+def init_worker(street_blocks):
+    """Build the matching engine of a worker process"""
+    global worker_engine
+    worker_engine = SegmentEngine(street_blocks, StreetBlockIndex(street_blocks))
+
+
+def match_coordinates(coordinates_list):
+    """Street block ids crossed by each route, run in a worker process"""
+    matches = []
+
+    for coordinates in coordinates_list:
+        crossed = worker_engine.blocks_crossed(LineArray(populate_segments(coordinates)))
+        matches.append(crossed.nonzero()[0].tolist())
+
+    return matches
+
+
+def read_conversation_data_parallel(doc, street_blocks, workers=None):
+    """Read in conversation routes and notes, matching routes in a process pool.
+
+    Yields the same conversations as xml_utils.read_conversation_data, in the
+    same order.
+    """
+    namespace = get_kml_namespace()
+    doc = document_index(doc)
+    style_map_dict, style_nodes_dict = read_style_dicts(doc)
+    resident_folders = read_resident_folders(doc)
+
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(street_blocks,)) as executor:
+        tasks = []
+        for resident_folder in resident_folders:
+            coordinates_list = read_route_coordinates(resident_folder)
+            tasks.append((coordinates_list, executor.submit(match_coordinates, coordinates_list)))
+
+        for resident_folder, (coordinates_list, future) in zip(resident_folders, tasks):
+            route_matches = {}
+            for coordinates, block_ids in zip(coordinates_list, future.result()):
+                route_matches[coordinates] = [street_blocks[block_id] for block_id in block_ids]
+
+            yield read_resident_folder(resident_folder, namespace, style_map_dict, street_blocks,
+                                       style_nodes_dict, route_matches=route_matches)
@@ -0,0 +1,53 @@
+"""In-run memoization of identical hand drawn paths
+
+Volunteers often copy one route placemark into several coded folders, and
+each copy would be matched to the street blocks again. PathMemo wraps a
+block index and keeps the blocks matched for recent paths, keyed by a hash
+of the parsed path. Keying on the parsed coordinates rather than their text
+also catches copies that only differ in whitespace or number formatting.
+The memo is bounded, dropping the least recently used path first.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+from RouteEntities import lines_to_array
+from profiling import counters
+
+# Paths remembered by default
+DEFAULT_SIZE = 4096
+
+
+class PathMemo(object):
+    """LRU memo of the street blocks crossed by each path"""
+
+    def __init__(self, block_index, size=DEFAULT_SIZE):
+        # block_index is a StreetBlockIndex, SegmentEngine or anything else with find_overlapping
+        self.block_index = block_index
+        self.size = size
+        self.paths = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def find_overlapping(self, path_measure_lines):
+        """Blocks the path crosses, matched once per distinct path"""
+        segments = lines_to_array(path_measure_lines)
+        key = hashlib.sha1(segments.tobytes()).digest()
+        blocks = self.paths.get(key)
+
+        if blocks is not None:
+            self.hits += 1
+            counters['path_memo_hits'] += 1
+            self.paths.move_to_end(key)
+            return list(blocks)
+
+        self.misses += 1
+        counters['path_memo_misses'] += 1
+        blocks = self.block_index.find_overlapping(path_measure_lines)
+
+        if self.size > 0:
+            self.paths[key] = list(blocks)
+            if len(self.paths) > self.size:
+                self.paths.popitem(last=False)
+
+        return blocks
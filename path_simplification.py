@@ -0,0 +1,125 @@
+"""Douglas-Peucker simplification of hand drawn paths before matching
+
+Hand drawn routes carry many jittery vertices, and every segment is tested
+against the trigger lines of the blocks near it. SimplifyingMatcher drops the
+vertices that lie within a tolerance of the simplified path before the path
+is matched. The tolerance is kept well below the trigger line distance, so
+the simplified path crosses the same trigger lines in all but borderline
+cases. In verify mode every route is matched both ways; the unsimplified
+result is used and any difference is reported.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from RouteEntities import TRIGGER_DISTANCE, LineArray, lines_to_array, segments_from_vertices
+from profiling import counters
+from xml_utils import is_block_overlapping
+
+# Default simplification tolerance, a tenth of the trigger distance
+DEFAULT_TOLERANCE = TRIGGER_DISTANCE / 10
+
+
+def distances_to_segment(points, start, end):
+    """Distance of each of points to the segment from start to end"""
+    direction = end - start
+    length = np.dot(direction, direction)
+    offsets = points - start
+
+    if length == 0:
+        return np.hypot(offsets[:, 0], offsets[:, 1])
+
+    t = np.clip(np.dot(offsets, direction) / length, 0, 1)
+    nearest = offsets - t[:, np.newaxis] * direction
+    return np.hypot(nearest[:, 0], nearest[:, 1])
+
+
+def simplify_vertices(vertices, tolerance):
+    """Douglas-Peucker simplification of a (K, 2) vertex array.
+
+    Keeps the end points, and every vertex further than tolerance from the
+    simplified path between its neighbors.
+    """
+    if len(vertices) < 3:
+        return vertices
+
+    keep = np.zeros(len(vertices), dtype=bool)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(vertices) - 1)]
+
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+
+        distances = distances_to_segment(vertices[first + 1:last], vertices[first], vertices[last])
+        farthest = int(np.argmax(distances))
+
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            ranges.append((first, split))
+            ranges.append((split, last))
+
+    return vertices[keep]
+
+
+def simplify_segments(segments, tolerance):
+    """Simplify the path of an (N, 4) array of consecutive segments"""
+    if len(segments) < 2:
+        return segments
+
+    vertices = np.vstack((segments[:, :2], segments[-1:, 2:]))
+    return segments_from_vertices(simplify_vertices(vertices, tolerance))
+
+
+class SimplifyingMatcher(object):
+    """Match paths to street blocks after simplifying them.
+
+    Wraps a StreetBlockIndex or SegmentEngine, or the reference loop over
+    street_blocks when block_index is None, and can be passed anywhere a
+    block_index is taken.
+    """
+
+    def __init__(self, street_blocks, block_index=None, tolerance=DEFAULT_TOLERANCE, verify=False):
+        if not 0 <= tolerance < TRIGGER_DISTANCE:
+            raise ValueError('Simplification tolerance must be below the trigger distance ' + str(TRIGGER_DISTANCE))
+
+        self.street_blocks = street_blocks
+        self.block_index = block_index
+        self.tolerance = tolerance
+        self.verify = verify
+        self.segments_read = 0
+        self.segments_removed = 0
+        self.mismatches = 0
+
+    def match(self, path_measure_lines):
+        if self.block_index is not None:
+            return self.block_index.find_overlapping(path_measure_lines)
+
+        path_measure_lines = list(path_measure_lines)
+        counters['blocks_scanned'] += len(self.street_blocks)
+        return [block for block in self.street_blocks if is_block_overlapping(block, path_measure_lines)]
+
+    def find_overlapping(self, path_measure_lines):
+        """Blocks the simplified path crosses, in street block order"""
+        segments = lines_to_array(path_measure_lines)
+        simplified = simplify_segments(segments, self.tolerance)
+
+        self.segments_read += len(segments)
+        self.segments_removed += len(segments) - len(simplified)
+        counters['segments_simplified_away'] += len(segments) - len(simplified)
+
+        blocks = self.match(LineArray(simplified))
+
+        if self.verify:
+            full_blocks = self.match(LineArray(segments))
+            if full_blocks != blocks:
+                self.mismatches += 1
+                counters['simplification_mismatches'] += 1
+                print('WARN: Simplified path matches {0} street blocks instead of {1}. Using the full path ...'
+                      .format(len(blocks), len(full_blocks)))
+                return full_blocks
+
+        return blocks
@@ -0,0 +1,142 @@
+"""Per-stage and per-resident instrumentation of a pipeline run
+
+RunProfiler records the wall time and peak traced memory of each stage of
+draw_trigger_lines.py and of each resident read. It also keeps the change in
+the hot path counters below, and writes everything as a JSON report.
+Optionally the whole run goes through cProfile as well.
+
+The counters are updated by the matching code itself and are always on.
+Work done in worker processes (--workers) is not counted.
+"""
+
+import cProfile
+import json
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Hot path work done so far:
+#  intersection_tests: trigger line x path segment crossing tests evaluated
+#  blocks_scanned: street blocks whose trigger lines were tested against a path
+#  routes_matched: routes matched against the street blocks
+#  routes_reused: routes whose matches were passed in through route_matches
+#  unknown_color_routes_skipped: routes skipped because of an unknown line color
+#  path_memo_hits: routes whose path was matched before in this run
+#  path_memo_misses: routes matched because their path was not in the path memo
+#  segments_simplified_away: route segments removed by path simplification
+#  simplification_mismatches: simplified routes matched to other blocks than the full ones
+counters = Counter()
+
+
+class RunProfiler(object):
+    """Wall time, peak memory and counters of the stages and residents of a run"""
+
+    def __init__(self, trace_memory=False, profile_path=None):
+        self.trace_memory = trace_memory
+        self.profile_path = profile_path
+        self.profile = None
+        self.stages = []
+        self.residents = []
+        self.open_records = []
+        self.start_time = None
+        self.peak = 0
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+        if self.trace_memory:
+            tracemalloc.start()
+
+        if self.profile_path:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.trace_memory:
+            self.fold_peak(tracemalloc.get_traced_memory()[1])
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_path)
+            self.profile = None
+
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """Record the block run inside the with statement as a stage"""
+        record = self.begin(name)
+        yield
+        self.stages.append(self.end(record))
+
+    def iter_residents(self, conversation_data):
+        """Pass conversations through, recording the time spent reading each one"""
+        iterator = iter(conversation_data)
+
+        while True:
+            record = self.begin(None)
+            try:
+                datum = next(iterator)
+            except StopIteration:
+                self.open_records.remove(record)
+                return
+
+            record['name'] = datum[0].residentName
+            self.residents.append(self.end(record))
+            yield datum
+
+    def begin(self, name):
+        record = {'name': name, 'start': time.perf_counter(), 'counters': Counter(counters), 'peak': 0}
+
+        if self.trace_memory:
+            # Enclosing records must still see the peak reached so far
+            self.fold_peak(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        self.open_records.append(record)
+        return record
+
+    def end(self, record):
+        self.open_records.remove(record)
+        result = {'name': record['name'],
+                  'seconds': time.perf_counter() - record['start'],
+                  'counters': dict(counters - record['counters'])}
+
+        if self.trace_memory:
+            peak = max(record['peak'], tracemalloc.get_traced_memory()[1])
+            self.fold_peak(peak)
+            result['peak_memory_bytes'] = peak
+
+        return result
+
+    def fold_peak(self, peak):
+        self.peak = max(self.peak, peak)
+        for record in self.open_records:
+            record['peak'] = max(record['peak'], peak)
+
+    def report(self):
+        report = {'seconds': time.perf_counter() - self.start_time,
+                  'counters': dict(counters),
+                  'stages': self.stages,
+                  'residents': sorted(self.residents, key=lambda resident: resident['seconds'], reverse=True)}
+
+        if self.trace_memory:
+            report['peak_memory_bytes'] = self.peak
+
+        if resource is not None:
+            report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return report
+
+    def write_report(self, output_path):
+        """Write the report as JSON, slowest residents first"""
+        with open(output_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+            report_file.write('\n')
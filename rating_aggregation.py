@@ -0,0 +1,125 @@
+"""Columnar rating aggregation for the compilations
+
+The compilations rate every street block per route folder, ability and code
+by the modes of the ratings residents gave it. RatingAggregator keeps the
+ratings in a RatingMatrix and groups its columns by (folder, ability, code).
+The rows of each group are counted into a (block, rating) array. Modes and
+the max or min of modes rules then run as array operations over all blocks
+of a group at once. Blocks are referred to by id throughout, so no geometry
+is copied.
+"""
+
+import numpy as np
+
+from rating_matrix import RatingMatrix
+
+# Which mode rule each ability uses when a block's ratings have several modes
+MODE_RULES = {'WNOS': max,
+              'BNCRC': max,
+              'WNSSS': min,
+              'BNAAS': min,
+              '': max}  # hypotheticals
+
+# Column fields the compilations group ratings by
+GROUP_FIELDS = ('folder', 'ability', 'code')
+
+
+class RatingAggregator(object):
+    """Rating counts of street blocks by route folder, ability and code"""
+
+    def __init__(self, fallback_rating, matrix=None):
+        # fallback_rating(ratings, ability) rates blocks of abilities without a mode rule
+        self.fallback_rating = fallback_rating
+        self.matrix = RatingMatrix() if matrix is None else matrix
+
+        self.group_folders = None
+        self.rating_values = None
+        self.rank = None
+        self.rows = None
+        self.offsets = None
+        self.aggregated_size = None
+
+    def add(self, folder_name, ability, coded_folders, resident=None):
+        """Add the rated routes of a resident's route folder"""
+        self.matrix.add(resident, folder_name, ability, coded_folders)
+
+    @property
+    def folders(self):
+        """folder -> ability -> code -> group id, in first seen order"""
+        self.aggregate()
+        return self.group_folders
+
+    @property
+    def blocks(self):
+        return self.matrix.blocks
+
+    def aggregate(self):
+        """Group the rows of the matrix by folder, ability and code, if not done since the last add"""
+        size = (len(self.matrix.columns), len(self.matrix))
+        if self.aggregated_size == size:
+            return
+
+        keys, self.rows, self.offsets = self.matrix.grouped_rows(GROUP_FIELDS)
+
+        self.group_folders = {}
+        for group, (folder_name, ability, code) in enumerate(keys):
+            self.group_folders.setdefault(folder_name, {}).setdefault(ability, {})[code] = group
+
+        # Order the rating axis by value, so the max and min of modes are the last and first columns
+        self.rating_values, self.rank = self.matrix.sorted_ratings()
+        self.aggregated_size = size
+
+    def group_counts(self, group):
+        """Ids of the blocks rated in a group, in the order they were first rated, and their rating counts"""
+        self.aggregate()
+        rows = self.rows[self.offsets[group]:self.offsets[group + 1]]
+        return self.matrix.block_counts(rows, self.rank)
+
+    def group_ratings(self, group, ability):
+        """Block ids of a group and the rating of each, by the ability's mode rule"""
+        block_ids, counts = self.group_counts(group)
+
+        if len(block_ids) == 0:
+            return [], []
+
+        rule = MODE_RULES.get(ability)
+
+        if rule is None:
+            ratings = [self.fallback_rating(self.rating_list(block_counts), ability) for block_counts in counts]
+            return block_ids.tolist(), ratings
+
+        modes = counts == counts.max(axis=1)[:, np.newaxis]
+        if rule is max:
+            columns = modes.shape[1] - 1 - np.argmax(modes[:, ::-1], axis=1)
+        else:
+            columns = np.argmax(modes, axis=1)
+
+        return block_ids.tolist(), [self.rating_values[column] for column in columns.tolist()]
+
+    def rating_list(self, block_counts):
+        """The ratings a block was given, from its row of counts"""
+        ratings = []
+        for rating, count in zip(self.rating_values, block_counts.tolist()):
+            ratings.extend([rating] * count)
+        return ratings
+
+    def code_ratings(self, code_dict, ability, rollup_code=None):
+        """(code, block ids, ratings) of each code of an ability, in first seen order.
+
+        With rollup_code, a further code holds every code's blocks one after
+        another, each rated as in its own code.
+        """
+        results = [(code,) + self.group_ratings(group, ability) for code, group in code_dict.items()]
+
+        if rollup_code is not None:
+            rollup = (rollup_code,
+                      [block_id for code, block_ids, ratings in results for block_id in block_ids],
+                      [rating for code, block_ids, ratings in results for rating in ratings])
+
+            codes = [code for code, block_ids, ratings in results]
+            if rollup_code in codes:
+                results[codes.index(rollup_code)] = rollup
+            else:
+                results.append(rollup)
+
+        return results
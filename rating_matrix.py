@@ -0,0 +1,184 @@
+"""Sparse matrix of the ratings residents gave street blocks
+
+RatingMatrix holds the match results of every resident in coordinate (COO)
+form: one (column, block, rating) row per street block crossed by a rated
+route. A column is one (resident, route folder, ability, code) combination;
+blocks and ratings are integer ids as well. Only blocks actually rated take
+up space, so it stays small for large cities. Compilations and statistics
+group the columns by some of their fields and reduce the rows with array
+operations, instead of walking the conversation objects again.
+"""
+
+import numpy as np
+
+# Fields of a column key, in order
+COLUMN_FIELDS = ('resident', 'folder', 'ability', 'code')
+
+
+class RatingMatrix(object):
+    """Ratings of street blocks by resident, route folder, ability and code"""
+
+    def __init__(self):
+        self.columns = []
+        self.column_ids = {}
+        self.blocks = []
+        self.block_ids = {}
+        self.rating_values = []
+        self.rating_ids = {}
+
+        self.column_rows = []
+        self.block_rows = []
+        self.rating_rows = []
+        self.row_arrays = None
+
+    def __len__(self):
+        return len(self.column_rows)
+
+    def add(self, resident, folder_name, ability, coded_folders):
+        """Add the rated routes of a resident's route folder.
+
+        Every coded folder gets a column, even without rated routes. Routes
+        without a rating (below 0) are left out.
+        """
+        for coded_folder in coded_folders:
+            column_id = self.column_id((resident, folder_name, ability, coded_folder.code))
+
+            for route in coded_folder.routes:
+                if route.rating < 0:
+                    continue
+
+                rating_id = self.rating_id(route.rating)
+
+                for block in route.street_blocks:
+                    self.column_rows.append(column_id)
+                    self.block_rows.append(self.block_id(block))
+                    self.rating_rows.append(rating_id)
+
+        self.row_arrays = None
+
+    def column_id(self, key):
+        column_id = self.column_ids.get(key)
+
+        if column_id is None:
+            column_id = self.column_ids[key] = len(self.columns)
+            self.columns.append(key)
+
+        return column_id
+
+    def block_id(self, block):
+        block_id = self.block_ids.get(block)
+
+        if block_id is None:
+            block_id = self.block_ids[block] = len(self.blocks)
+            self.blocks.append(block)
+
+        return block_id
+
+    def rating_id(self, rating):
+        rating_id = self.rating_ids.get(rating)
+
+        if rating_id is None:
+            rating_id = self.rating_ids[rating] = len(self.rating_values)
+            self.rating_values.append(rating)
+
+        return rating_id
+
+    def arrays(self):
+        """Column, block and rating ids of every row, as arrays"""
+        if self.row_arrays is None:
+            self.row_arrays = (np.array(self.column_rows, dtype=np.intp),
+                               np.array(self.block_rows, dtype=np.intp),
+                               np.array(self.rating_rows, dtype=np.intp))
+        return self.row_arrays
+
+    def sorted_ratings(self):
+        """Rating values in increasing order, and the rank of each rating id among them"""
+        order = sorted(range(len(self.rating_values)), key=self.rating_values.__getitem__)
+        rank = np.empty(len(order), dtype=np.intp)
+        rank[order] = np.arange(len(order))
+        return [self.rating_values[i] for i in order], rank
+
+    def group_columns(self, fields):
+        """Group id of every column by the given fields, and the key of each group, in first seen order"""
+        indexes = [COLUMN_FIELDS.index(field) for field in fields]
+        group_ids = {}
+        groups = np.empty(len(self.columns), dtype=np.intp)
+
+        for column_id, column in enumerate(self.columns):
+            key = tuple(column[i] for i in indexes)
+            groups[column_id] = group_ids.setdefault(key, len(group_ids))
+
+        return groups, list(group_ids)
+
+    def grouped_rows(self, fields):
+        """Rows sorted by their group of columns, keeping row order within a group.
+
+        Returns the group keys, the sorted row numbers, and the offset of each
+        group's rows in them.
+        """
+        groups, keys = self.group_columns(fields)
+        row_groups = groups[self.arrays()[0]]
+        rows = np.argsort(row_groups, kind='stable')
+        offsets = np.searchsorted(row_groups[rows], np.arange(len(keys) + 1))
+        return keys, rows, offsets
+
+    def block_counts(self, rows, rank):
+        """Blocks of rows, in the order first rated, and their counts of each rating.
+
+        rank maps rating ids to count columns, see sorted_ratings.
+        """
+        columns, blocks, ratings = self.arrays()
+        block_ids, first, inverse = np.unique(blocks[rows], return_index=True, return_inverse=True)
+
+        # Renumber blocks by first appearance
+        order = np.argsort(first, kind='stable')
+        position = np.empty(len(order), dtype=np.intp)
+        position[order] = np.arange(len(order))
+
+        counts = np.zeros((len(block_ids), len(rank)), dtype=np.int32)
+        np.add.at(counts, (position[inverse.ravel()], rank[ratings[rows]]), 1)
+        return block_ids[order], counts
+
+    def rated_rows(self, ratings=None):
+        """Row mask of the rows whose rating is one of ratings, or all rows"""
+        rating_ids = self.arrays()[2]
+
+        if ratings is None:
+            return np.ones(len(rating_ids), dtype=bool)
+
+        allowed = np.array([rating in ratings for rating in self.rating_values], dtype=bool)
+        return allowed[rating_ids] if len(rating_ids) else np.zeros(0, dtype=bool)
+
+    def block_stats(self, ratings=None):
+        """Per block statistics over the rows rated one of ratings, or all rows.
+
+        A dict of arrays indexed by block id: count of ratings, mean, min and
+        max rating (NaN for blocks without ratings), and the number of
+        distinct residents rating the block.
+        """
+        columns, blocks, rating_ids = self.arrays()
+        rows = self.rated_rows(ratings)
+        block_rows = blocks[rows]
+        values = np.array(self.rating_values, dtype=np.float64)[rating_ids[rows]]
+        block_count = len(self.blocks)
+
+        count = np.bincount(block_rows, minlength=block_count)
+        total = np.bincount(block_rows, weights=values, minlength=block_count)
+        low = np.full(block_count, np.inf)
+        high = np.full(block_count, -np.inf)
+        np.minimum.at(low, block_rows, values)
+        np.maximum.at(high, block_rows, values)
+
+        residents, resident_keys = self.group_columns(('resident',))
+        pairs = np.unique(block_rows * max(len(resident_keys), 1) + residents[columns[rows]])
+        distinct_residents = np.bincount(pairs // max(len(resident_keys), 1), minlength=block_count)
+
+        rated = count > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(rated, total / count, np.nan)
+
+        return {'count': count,
+                'mean': mean,
+                'min': np.where(rated, low, np.nan),
+                'max': np.where(rated, high, np.nan),
+                'residents': distinct_residents}
@@ -0,0 +1,170 @@
+"""Vectorized segment intersection for trigger lines and hand drawn paths
+
+The functions here evaluate the same orientation tests as ccw, intersect and
+lines_cross in xml_utils, but on whole arrays of segments at once. Segments
+are rows of (longitude1, latitude1, longitude2, latitude2). The arithmetic is
+done in the same order as the reference functions, so the results match them
+exactly.
+"""
+
+import numpy as np
+
+from RouteEntities import lines_to_array
+from profiling import counters
+
+# Upper bound on trigger line x path segment pairs evaluated in one pass
+MAX_PAIRS = 1 << 20
+
+
+def ccw(ax, ay, bx, by, cx, cy):
+    """Broadcast version of xml_utils.ccw"""
+    return (cy - ay) * (bx - ax) > (by - ay) * (cx - ax)
+
+
+def segments_cross(trigger_lines, segments, max_pairs=MAX_PAIRS):
+    """For each trigger line in an (N, 4) array, whether any of the (M, 4)
+    path segments crosses it"""
+    crossed = np.zeros(len(trigger_lines), dtype=bool)
+
+    if len(trigger_lines) == 0 or len(segments) == 0:
+        return crossed
+
+    cx, cy, dx, dy = segments.T
+    step = max(1, max_pairs // len(segments))
+
+    for start in range(0, len(trigger_lines), step):
+        chunk = trigger_lines[start:start + step]
+        ax, ay, bx, by = (column[:, np.newaxis] for column in chunk.T)
+
+        hits = (ccw(ax, ay, cx, cy, dx, dy) != ccw(bx, by, cx, cy, dx, dy)) & \
+               (ccw(ax, ay, bx, by, cx, cy) != ccw(ax, ay, bx, by, dx, dy))
+        crossed[start:start + step] = hits.any(axis=1)
+
+    return crossed
+
+
+def pairs_cross(trigger_lines, segments):
+    """For each row, whether the trigger line crosses the path segment in the same row"""
+    ax, ay, bx, by = trigger_lines.T
+    cx, cy, dx, dy = segments.T
+    return (ccw(ax, ay, cx, cy, dx, dy) != ccw(bx, by, cx, cy, dx, dy)) & \
+           (ccw(ax, ay, bx, by, cx, cy) != ccw(ax, ay, bx, by, dx, dy))
+
+
+def blocks_crossed(trigger_lines, owners, block_count, segments):
+    """For each block, whether any path segment crosses one of its trigger lines
+
+    owners holds the block id of every row in trigger_lines.
+    """
+    crossed = np.zeros(block_count, dtype=bool)
+    crossed[owners[segments_cross(trigger_lines, segments)]] = True
+    return crossed
+
+
+class SegmentEngine(object):
+    """All trigger lines of a city packed into one array for batched matching.
+
+    Rows that cannot touch the path are dropped with a bounding box test
+    before the orientation tests run. When a StreetBlockIndex is given, only
+    the trigger lines of its candidate blocks are considered at all.
+    """
+
+    def __init__(self, street_blocks, block_index=None, padding=1e-9):
+        self.street_blocks = list(street_blocks)
+        self.block_index = block_index
+        self.padding = padding
+
+        counts = [len(block.trigger_lines) for block in self.street_blocks]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.intp)
+        self.owners = np.repeat(np.arange(len(self.street_blocks)), counts)
+        self.trigger_lines = np.concatenate(
+            [np.zeros((0, 4))] + [block.trigger_segments for block in self.street_blocks])
+
+        self.min_lon = np.minimum(self.trigger_lines[:, 0], self.trigger_lines[:, 2])
+        self.max_lon = np.maximum(self.trigger_lines[:, 0], self.trigger_lines[:, 2])
+        self.min_lat = np.minimum(self.trigger_lines[:, 1], self.trigger_lines[:, 3])
+        self.max_lat = np.maximum(self.trigger_lines[:, 1], self.trigger_lines[:, 3])
+
+    def candidate_rows(self, segments, path_measure_lines):
+        """Trigger line rows whose bounding box meets the path's"""
+        if self.block_index is not None:
+            block_ids = self.block_index.candidate_ids(path_measure_lines)
+            if not block_ids:
+                return np.zeros(0, dtype=np.intp)
+            rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in block_ids])
+        else:
+            rows = np.arange(len(self.trigger_lines))
+
+        # Segments with a NaN end cannot cross anything, so they do not widen the box
+        segments = segments[~np.isnan(segments).any(axis=1)]
+        if len(segments) == 0:
+            return np.zeros(0, dtype=np.intp)
+
+        lons = np.concatenate((segments[:, 0], segments[:, 2]))
+        lats = np.concatenate((segments[:, 1], segments[:, 3]))
+        keep = (self.max_lon[rows] >= lons.min() - self.padding) & \
+               (self.min_lon[rows] <= lons.max() + self.padding) & \
+               (self.max_lat[rows] >= lats.min() - self.padding) & \
+               (self.min_lat[rows] <= lats.max() + self.padding)
+        return rows[keep]
+
+    def blocks_crossed(self, path_measure_lines):
+        """Boolean array over street blocks: does the path cross the block"""
+        segments = lines_to_array(path_measure_lines)
+
+        if len(segments) == 0:
+            return np.zeros(len(self.street_blocks), dtype=bool)
+
+        rows = self.candidate_rows(segments, path_measure_lines)
+        self.count_tests(rows, segments)
+
+        return blocks_crossed(self.trigger_lines[rows], self.owners[rows], len(self.street_blocks), segments)
+
+    def count_tests(self, rows, segments):
+        if len(rows):
+            # Rows are grouped by block, so each change of owner starts another block
+            counters['blocks_scanned'] += 1 + int(np.count_nonzero(np.diff(self.owners[rows])))
+        counters['intersection_tests'] += int(len(rows)) * len(segments)
+
+    def blocks_crossed_batch(self, paths, max_pairs=MAX_PAIRS):
+        """Boolean (paths, blocks) array: does each path cross each block.
+
+        The candidate (trigger line, segment) pairs of all paths are tested
+        together, in chunks of at most max_pairs.
+        """
+        crossed = np.zeros((len(paths), len(self.street_blocks)), dtype=bool)
+        segment_arrays = [lines_to_array(path_measure_lines) for path_measure_lines in paths]
+        lengths = [len(segments) for segments in segment_arrays]
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+
+        pair_rows = []
+        pair_segments = []
+
+        for path_id, segments in enumerate(segment_arrays):
+            if len(segments) == 0:
+                continue
+
+            rows = self.candidate_rows(segments, paths[path_id])
+            self.count_tests(rows, segments)
+            pair_rows.append(np.repeat(rows, len(segments)))
+            pair_segments.append(np.tile(np.arange(offsets[path_id], offsets[path_id + 1]), len(rows)))
+
+        if not pair_rows:
+            return crossed
+
+        all_segments = np.concatenate(segment_arrays)
+        segment_paths = np.repeat(np.arange(len(paths)), lengths)
+        pair_rows = np.concatenate(pair_rows)
+        pair_segments = np.concatenate(pair_segments)
+
+        for start in range(0, len(pair_rows), max_pairs):
+            rows = pair_rows[start:start + max_pairs]
+            segments = pair_segments[start:start + max_pairs]
+            hits = pairs_cross(self.trigger_lines[rows], all_segments[segments])
+            crossed[segment_paths[segments[hits]], self.owners[rows[hits]]] = True
+
+        return crossed
+
+    def find_overlapping(self, path_measure_lines):
+        """Blocks the path crosses, in street block order"""
+        return [self.street_blocks[i] for i in np.flatnonzero(self.blocks_crossed(path_measure_lines))]
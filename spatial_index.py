@@ -0,0 +1,128 @@
+"""Spatial index over street block trigger lines"""
+
+import math
+
+import numpy as np
+
+from RouteEntities import lines_to_array
+from xml_utils import is_block_overlapping
+from profiling import counters
+
+
+def segment_bounds(segments):
+    """Bounding boxes of an (N, 4) segment array as (min_lon, min_lat, max_lon, max_lat) rows"""
+    return np.column_stack((np.minimum(segments[:, 0], segments[:, 2]),
+                            np.minimum(segments[:, 1], segments[:, 3]),
+                            np.maximum(segments[:, 0], segments[:, 2]),
+                            np.maximum(segments[:, 1], segments[:, 3])))
+
+
+class StreetBlockIndex(object):
+    """Uniform grid over the bounding boxes of every block's trigger lines.
+
+    Build it once after populate_trigger_lines. Each cell lists the blocks with
+    a trigger line touching it, so a route is only tested against the blocks
+    near its own segments. Boxes are padded slightly so rounding in the
+    crossing test can never drop a block the brute force search would find.
+    """
+
+    def __init__(self, street_blocks, cell_size=None, padding=1e-9):
+        self.street_blocks = list(street_blocks)
+        self.padding = padding
+        self.cells = {}
+
+        bounds = [segment_bounds(block.trigger_segments) for block in self.street_blocks]
+
+        if cell_size is None:
+            cell_size = default_cell_size(bounds)
+        self.cell_size = cell_size
+
+        for block_id, block_bounds in enumerate(bounds):
+            for box in block_bounds.tolist():
+                for cell in self.cells_for(box):
+                    members = self.cells.setdefault(cell, [])
+                    if not members or members[-1] != block_id:
+                        members.append(block_id)
+
+        # (min x, min y, max x, max y) of the occupied cells; no cell outside has blocks
+        if self.cells:
+            xs = [x for x, y in self.cells]
+            ys = [y for x, y in self.cells]
+            self.extent = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            self.extent = None
+
+    def cell_range(self, box):
+        """(min x, min y, max x, max y) of the grid cells covered by a padded bounding box"""
+        return (int(math.floor((box[0] - self.padding) / self.cell_size)),
+                int(math.floor((box[1] - self.padding) / self.cell_size)),
+                int(math.floor((box[2] + self.padding) / self.cell_size)),
+                int(math.floor((box[3] + self.padding) / self.cell_size)))
+
+    def cells_for(self, box):
+        """Yield the grid cells covered by a padded bounding box"""
+        min_x, min_y, max_x, max_y = self.cell_range(box)
+
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield x, y
+
+    def candidate_ids(self, path_measure_lines):
+        """Sorted ids of blocks whose trigger lines may cross the path"""
+        block_ids = set()
+
+        if self.extent is None:
+            return []
+
+        # Segments with a NaN end cannot cross anything, and infinite ends are
+        # clipped to just outside the occupied cells before picking cells
+        bounds = segment_bounds(lines_to_array(path_measure_lines))
+        bounds = bounds[~np.isnan(bounds).any(axis=1)]
+        low = (np.array(self.extent[:2]) - 1) * self.cell_size
+        high = (np.array(self.extent[2:]) + 2) * self.cell_size
+        bounds = np.clip(bounds, np.tile(low, 2), np.tile(high, 2))
+
+        for box in bounds.tolist():
+            # Only the occupied part of the grid can hold candidates, so a stray
+            # vertex far away (e.g. at 0,0) costs no more than the grid itself
+            min_x, min_y, max_x, max_y = self.cell_range(box)
+            min_x, min_y = max(min_x, self.extent[0]), max(min_y, self.extent[1])
+            max_x, max_y = min(max_x, self.extent[2]), min(max_y, self.extent[3])
+
+            if min_x > max_x or min_y > max_y:
+                continue
+
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+                for (x, y), members in self.cells.items():
+                    if min_x <= x <= max_x and min_y <= y <= max_y:
+                        block_ids.update(members)
+            else:
+                for x in range(min_x, max_x + 1):
+                    for y in range(min_y, max_y + 1):
+                        members = self.cells.get((x, y))
+                        if members:
+                            block_ids.update(members)
+
+        return sorted(block_ids)
+
+    def candidates(self, path_measure_lines):
+        """Blocks that may overlap the path, in their original order"""
+        return [self.street_blocks[block_id] for block_id in self.candidate_ids(path_measure_lines)]
+
+    def find_overlapping(self, path_measure_lines):
+        """Blocks the path crosses, tested one candidate at a time"""
+        path_measure_lines = list(path_measure_lines)
+        candidates = self.candidates(path_measure_lines)
+        counters['blocks_scanned'] += len(candidates)
+        return [block for block in candidates if is_block_overlapping(block, path_measure_lines)]
+
+
+def default_cell_size(bounds):
+    """Pick a cell about twice the size of an average trigger line"""
+    boxes = np.concatenate(bounds) if bounds else np.zeros((0, 4))
+
+    if len(boxes) == 0:
+        return 1.0
+
+    extent = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]).mean()
+    return 2 * extent if extent > 0 else 1.0
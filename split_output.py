@@ -0,0 +1,181 @@
+"""Final output split into one file per resident and per compilation branch
+
+write_split_kml writes each resident folder, and each compilation branch,
+to its own KML file next to a small root document. The walking and biking
+compilations are split further by ability. The root document references
+every file through a NetworkLink, so a viewer only loads a file when its
+link is opened. The files are written by a thread pool while residents are
+still being read, and every file carries the styles it uses.
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from lxml import etree
+
+from style_registry import StyleRegistry, style_urls
+from xml_utils import WalkingCompilation, get_kml_namespace, create_node, create_folder, append_node_with_text, \
+    append_final_styles, create_color_dict, create_resident_folder, register_resident_styles, \
+    is_output_style_id, create_gradient_compilation, write_kml_file
+
+# Compilation branches written as one file per ability
+ABILITY_BRANCHES = ("walking", "biking")
+
+DEFAULT_THREADS = 4
+
+
+def file_name(index, name, extension):
+    """A numbered file name safe on every platform"""
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', name or '').strip('_')
+    return '{0:04d}_{1}{2}'.format(index, slug, extension)
+
+
+def create_part_kml(name, styles, folder):
+    """A KML document holding styles and one folder"""
+    kml = etree.Element('kml', nsmap=get_kml_namespace())
+    document = create_node(kml, "Document", name)
+
+    for style in styles:
+        document.append(style)
+    document.append(folder)
+
+    return kml
+
+
+def append_network_link(parent, name, href):
+    network_link = create_node(parent, "NetworkLink", name)
+    link = etree.SubElement(network_link, "Link")
+    append_node_with_text(link, "href", href)
+    return network_link
+
+
+def final_styles():
+    document = etree.Element("Document")
+    append_final_styles(document)
+    return list(document)
+
+
+def referenced_styles(folder, styles):
+    """The styles folder uses, directly or through a StyleMap, in their order in styles"""
+    styles_by_url = dict(('#' + style.get('id'), style) for style in styles)
+    used = set()
+    pending = [node.text for node in style_urls(folder)]
+
+    while pending:
+        url = pending.pop()
+        if url in used or url not in styles_by_url:
+            continue
+        used.add(url)
+        pending.extend(node.text for node in style_urls(styles_by_url[url]))
+
+    return [style for style in styles if '#' + style.get('id') in used]
+
+
+def folder_name(folder):
+    return folder[0].text
+
+
+class PartWriter(object):
+    """Write part files in a thread pool, keeping a bounded number of them in memory"""
+
+    def __init__(self, directory, href_prefix, threads=DEFAULT_THREADS, pretty_print=True):
+        self.directory = directory
+        self.href_prefix = href_prefix
+        self.pretty_print = pretty_print
+        self.executor = ThreadPoolExecutor(threads)
+        self.max_pending = 2 * threads
+        self.pending = []
+
+    def write(self, subdirectory, name, kml):
+        """Queue a part file for writing; returns its href relative to the root document"""
+        os.makedirs(os.path.join(self.directory, subdirectory), exist_ok=True)
+        self.pending.append(self.executor.submit(write_kml_file, os.path.join(self.directory, subdirectory, name),
+                                                 kml, self.pretty_print))
+
+        while len(self.pending) > self.max_pending:
+            self.pending.pop(0).result()
+
+        return self.href_prefix + subdirectory + '/' + name
+
+    def close(self):
+        """Wait for every queued file, raising the first error"""
+        try:
+            for future in self.pending:
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+
+def write_split_kml(output_path, conversation_data, date, pretty_print=True, merge_lines=False, gradient_steps=0,
+                    threads=DEFAULT_THREADS):
+    """Write the final output as a root document linking to one file per resident and compilation branch.
+
+    The files go in a directory named after output_path, and have its
+    extension. Each file only carries the styles its folder uses.
+    conversation_data may be a generator still reading residents.
+    """
+    root_name, extension = os.path.splitext(output_path)
+    directory = root_name + '_files'
+
+    # Relative links in a KMZ resolve inside the archive, one level below the file itself
+    href_prefix = '../' if extension.lower() == '.kmz' else ''
+    parts = PartWriter(directory, href_prefix + os.path.basename(directory) + '/', threads, pretty_print)
+
+    kml = etree.Element('kml', nsmap=get_kml_namespace())
+    document = create_node(kml, "Document", "Final Python Output " + date.strftime("%m/%d/%y"))
+    conversations_folder = create_folder(document, "CONVERSATIONS")
+    compilations_links = create_folder(document, "COMPILATIONS")
+
+    color_dict = create_color_dict()
+    compilation = WalkingCompilation()
+
+    try:
+        for index, datum in enumerate(conversation_data):
+            conversation = datum[0]
+
+            # Styles are registered per file, as files cannot share them
+            style_registry = StyleRegistry(is_output_style_id)
+            register_resident_styles(style_registry, conversation)
+
+            resident_parent = etree.Element("Document")
+            create_resident_folder(resident_parent, datum, color_dict, merge_lines)
+            resident_folder = resident_parent[0]
+            part = create_part_kml(conversation.residentName,
+                                   referenced_styles(resident_folder, final_styles() + style_registry.elements()),
+                                   resident_folder)
+
+            href = parts.write('residents', file_name(index, conversation.residentName, extension), part)
+            append_network_link(conversations_folder, conversation.residentName, href)
+
+            compilation.add(datum)
+
+        compilation_styles = etree.Element("Document")
+        compilations_folder = etree.Element("Folder")
+        compilation.write(compilation_styles, compilations_folder, color_dict, merge_lines)
+        if gradient_steps:
+            create_gradient_compilation(compilation_styles, compilations_folder, compilation.aggregator.matrix,
+                                        color_dict, gradient_steps, merge_lines)
+
+        index = 0
+        for branch in list(compilations_folder.iterchildren("Folder")):
+            if folder_name(branch) in ABILITY_BRANCHES:
+                links = create_folder(compilations_links, folder_name(branch))
+                branches = [(folder_name(branch) + ' ' + folder_name(ability), ability)
+                            for ability in list(branch.iterchildren("Folder"))]
+            else:
+                links = compilations_links
+                branches = [(folder_name(branch), branch)]
+
+            for name, folder in branches:
+                styles = [deepcopy(style) for style in
+                          referenced_styles(folder, final_styles() + list(compilation_styles))]
+                href = parts.write('compilations', file_name(index, name, extension),
+                                   create_part_kml(name, styles, folder))
+                append_network_link(links, folder_name(folder), href)
+                index += 1
+    finally:
+        parts.close()
+
+    write_kml_file(output_path, kml, pretty_print)
@@ -0,0 +1,94 @@
+"""Document level registry of the styles copied into the final output
+
+Nontraditional placemarks and pass through folders keep the styleUrls they
+had in the input, so their Style and StyleMap nodes are copied along.
+StyleRegistry keeps one copy of each style, interned by id. Residents
+sharing a StyleMap share one copy. A style whose id is already taken by
+different content, or reserved by the output itself, is registered under its
+id with an "in_" prefix, plus a content hash if that is taken too, and the
+styleUrls pointing at it are rewritten. Each style is placed where appending
+the input nodes to the document one after another would have left it, i.e.
+by its last use.
+"""
+
+import hashlib
+from copy import deepcopy
+
+from lxml import etree
+
+
+def local_name(element):
+    return etree.QName(element).localname
+
+
+def style_urls(element):
+    """styleUrl nodes in and below element"""
+    return [node for node in element.iter(etree.Element) if local_name(node) == 'styleUrl']
+
+
+def rewrite_style_urls(element, urls):
+    """Point styleUrls in and below element at the ids urls maps them to"""
+    for node in style_urls(element):
+        if node.text in urls:
+            node.text = urls[node.text]
+
+
+class StyleRegistry(object):
+    """Styles of the final document, each kept once"""
+
+    def __init__(self, is_reserved=None):
+        # is_reserved(id) tells whether the output creates a style with that id itself
+        self.is_reserved = is_reserved or (lambda style_id: False)
+        self.styles = {}
+        self.keys = {}
+
+    def register(self, style, urls):
+        """Register a copy of style, with its styleUrls rewritten by urls; returns its id"""
+        copy = deepcopy(style)
+        rewrite_style_urls(copy, urls)
+
+        style_id = copy.attrib.pop('id')
+        tail = copy.tail
+        copy.tail = None
+        key = hashlib.sha1(etree.tostring(copy, method='c14n')).hexdigest()
+        copy.tail = tail
+
+        # Renamed ids get a prefix no reserved id has, then as much of the hash as it takes
+        candidates = [style_id, 'in_' + style_id] + \
+            ['in_' + style_id + '_' + key[:length] for length in range(8, len(key) + 1, 4)]
+
+        for registered_id in candidates:
+            if not self.is_reserved(registered_id) and self.keys.get(registered_id, key) == key:
+                break
+        else:
+            raise ValueError('No free id to register style ' + style_id + ' under')
+
+        if registered_id not in self.keys:
+            copy.set('id', registered_id)
+            self.keys[registered_id] = key
+            self.styles[registered_id] = copy
+
+        return registered_id
+
+    def register_all(self, styles):
+        """Register styles used together, Styles before the StyleMaps pointing at them.
+
+        Returns the styleUrl text of each registered style mapped to its new one.
+        """
+        urls = {}
+
+        for style in sorted(styles, key=lambda node: local_name(node) == 'StyleMap'):
+            url = '#' + style.get('id')
+            if url not in urls:
+                urls[url] = '#' + self.register(style, urls)
+
+        # Order by last use
+        for style in styles:
+            registered_id = urls['#' + style.get('id')][1:]
+            self.styles[registered_id] = self.styles.pop(registered_id)
+
+        return urls
+
+    def elements(self):
+        """Registered styles, in the order to write them"""
+        return list(self.styles.values())
@@ -1,8 +1,14 @@
+import re
 from copy import deepcopy
 
 from lxml import etree
+import numpy as np
 from RouteEntities import StreetBlock, PassThroughFolder, Conversation, ConversationFolder, ConversationCodedFolder, \
-    ConversationRoute, Color, populate_lines, NoteBundle
+    ConversationRoute, Color, populate_segments, LineArray, NoteBundle, format_coordinates, format_segments
+from kml_writer import KmlStreamWriter, open_kml_output
+from style_registry import StyleRegistry, rewrite_style_urls
+from profiling import counters
+from rating_aggregation import RatingAggregator
 
 color_3 = Color(255, 0, 255, 0)  # 'ff00ff00' Green
 color_2 = Color(255, 255, 255, 0)  # 'ff00ffff' Yellow
@@ -17,6 +23,7 @@ notes_folder_name = "Notes"
 hypotheticals_folder_name = "wConsider"
 hypothetical_rating = 1000
 would_consider_rating = 2000
+non_traditional_rating = 'nontraditional'
 
 
 #  Add a Notes folder to compilation -> 2 sub folders for push pins, avoided
@@ -33,24 +40,119 @@ def get_kml_namespace():
             'gx': 'http://www.google.com/kml/ext/2.2'}
 
 
+def kml_tag(name):
+    """Fully qualified tag name in the KML namespace"""
+    return '{' + get_kml_namespace()['kml'] + '}' + name
+
+
+def compile_xpath(path):
+    return etree.XPath(path, namespaces=get_kml_namespace())
+
+
+# Queries used while reading, compiled once
+sub_folders_xpath = compile_xpath('./kml:Folder')
+placemarks_xpath = compile_xpath('.//kml:Placemark')
+route_placemarks_xpath = compile_xpath('./kml:Folder//kml:Placemark')
+style_urls_xpath = compile_xpath('.//kml:styleUrl')
+description_xpath = compile_xpath('./kml:description')
+name_text_xpath = compile_xpath('.//kml:name/text()')
+
+STYLE_URL = kml_tag('styleUrl')
+COORDINATES = kml_tag('coordinates')
+LINE_STRING = kml_tag('LineString')
+STYLE = kml_tag('Style')
+STYLE_MAP = kml_tag('StyleMap')
+FOLDER = kml_tag('Folder')
+NAME = kml_tag('name')
+
+
+class DocumentIndex(object):
+    """Styles, StyleMaps and folders of a KML document, gathered in one walk over it.
+
+    The readers accept an index wherever they take a parsed document, so a
+    document read for street blocks and conversations is only walked once.
+    """
+
+    def __init__(self, doc):
+        self.styles = []
+        self.style_maps = []
+        self.folders = []
+        self.folder_names = []
+        self.style_dicts = None
+
+        for element in doc.iter(STYLE, STYLE_MAP, FOLDER):
+            if element.tag == STYLE:
+                self.styles.append(element)
+            elif element.tag == STYLE_MAP:
+                self.style_maps.append(element)
+            else:
+                self.folders.append(element)
+                self.folder_names.append([name.text or '' for name in element.iterchildren(NAME)])
+
+    def folder(self, prefix):
+        """First folder, in document order, with a name starting with prefix"""
+        for folder, names in zip(self.folders, self.folder_names):
+            if any(name.startswith(prefix) for name in names):
+                return folder
+
+        raise IndexError('No folder named ' + prefix + '...')
+
+    def read_style_dicts(self):
+        """style_map_dict and style_nodes_dict of the document, resolved on first use"""
+        if self.style_dicts is None:
+            style_dict = {}
+            cache_styles(self.styles, style_dict)
+
+            style_map_dict = {}
+            style_nodes_dict = {}
+            cache_style_maps(self.style_maps, style_dict, style_map_dict, style_nodes_dict)
+
+            self.style_dicts = style_map_dict, style_nodes_dict
+
+        return self.style_dicts
+
+
+def document_index(doc):
+    """Index of a parsed document, or doc itself if it already is one"""
+    if isinstance(doc, DocumentIndex):
+        return doc
+
+    return DocumentIndex(doc)
+
+
 def read_street_blocks(doc):
     """Read in street blocks from KML document"""
-    namespace = get_kml_namespace()
+    folder = document_index(doc).folder('STREETBLOCKS ')
 
-    folder = doc.xpath("//kml:Folder[./kml:name[starts-with(.,'STREETBLOCKS ')]]",
-                       namespaces=namespace)[0]
+    for placemark in placemarks_xpath(folder):
+        yield create_street_block(placemark)
 
-    for placemark in folder.xpath('.//kml:Placemark', namespaces=namespace):
-        # placemark[3][1] for new
-        # placemark[2][1] for old
-        if placemark[1].text == "0":
-            yield StreetBlock(placemark[0].text, placemark[3][1].text.strip())
-        else:
-            yield StreetBlock(placemark[0].text, placemark[2][1].text.strip())
+
+def read_street_block_fields(doc):
+    """Read the name and coordinate text of every street block, without parsing the coordinates"""
+    folder = document_index(doc).folder('STREETBLOCKS ')
+
+    for placemark in placemarks_xpath(folder):
+        yield street_block_fields(placemark)
+
+
+def create_street_block(placemark):
+    """Create a street block from its placemark"""
+    return StreetBlock(*street_block_fields(placemark))
+
+
+def street_block_fields(placemark):
+    """Name and coordinate text of a street block placemark"""
+    # placemark[3][1] for new
+    # placemark[2][1] for old
+    if placemark[1].text == "0":
+        return placemark[0].text, placemark[3][1].text.strip()
+    else:
+        return placemark[0].text, placemark[2][1].text.strip()
 
 
 def create_pass_through_folder(folder_root, style_nodes_dict, namespace):
-    style_urls = folder_root.xpath('.//kml:styleUrl', namespaces=namespace)
+    style_urls = style_urls_xpath(folder_root)
     styles = []
 
     for url in style_urls:
@@ -59,73 +161,144 @@ def create_pass_through_folder(folder_root, style_nodes_dict, namespace):
     return PassThroughFolder(folder_root, styles)
 
 
-def read_conversation_data(doc, street_blocks):
+def read_conversation_data(doc, street_blocks, block_index=None, route_matches=None):
     """Read in conversation routes and notes from KML document"""
     namespace = get_kml_namespace()
+    doc = document_index(doc)
+    style_map_dict, style_nodes_dict = read_style_dicts(doc)
+
+    for residentFolder in read_resident_folders(doc):
+
+        # if 'Ailin' not in residentFolder[0].text: continue
+
+        yield read_resident_folder(residentFolder, namespace, style_map_dict, street_blocks, style_nodes_dict,
+                                   block_index, route_matches)
+
+
+def read_style_dicts(doc):
+    """Cache the document's styles for reading conversations"""
+    return document_index(doc).read_style_dicts()
+
+
+def read_resident_folders(doc):
+    """Find the resident folders of the hand drawn conversations"""
+    folder = document_index(doc).folder('hdConversations ')
 
-    # Cache style -> color maps
-    style_dict = {}
-    for style in doc.xpath('//kml:Style', namespaces=namespace):
+    return sub_folders_xpath(folder)
+
+
+def cache_styles(styles, style_dict):
+    """Add Style nodes with an id to the style dictionary"""
+    for style in styles:
         if len(style.attrib) > 0:
             style_dict['#' + style.attrib['id']] = style
 
-    # Cache the style maps
-    style_map_dict = {}
-    style_nodes_dict = {}
-    for style_map in doc.xpath('//kml:StyleMap', namespaces=namespace):
-        style_url = style_map.xpath('.//kml:styleUrl', namespaces=namespace)
-        style_map_dict['#' + style_map.attrib['id']] = style_dict[style_url[0].text]
+
+def cache_style_maps(style_maps, style_dict, style_map_dict, style_nodes_dict):
+    """Resolve StyleMap nodes against the style dictionary.
+
+    style_map_dict gets the line color and route rating of each StyleMap, see
+    style_rating; style_nodes_dict gets the nodes to copy along with it.
+    """
+    for style_map in style_maps:
+        style_url = list(style_map.iter(STYLE_URL))
+        style_map_dict['#' + style_map.attrib['id']] = style_rating(style_dict[style_url[0].text])
 
         # Add all needed nodes for this style map
         style_nodes_dict['#' + style_map.attrib['id']] = [style_map, style_dict[style_url[0].text],
                                                           style_dict[style_url[1].text]]
 
-    folder = doc.xpath("//kml:Folder[./kml:name[starts-with(.,'hdConversations ')]]", namespaces=namespace)[0]
 
-    residentFolders = folder.xpath("./kml:Folder", namespaces=namespace)
+def style_rating(style):
+    """Color and route rating of a StyleMap's normal style.
+
+    The color is the text of the style's first grandchild, usually
+    LineStyle/color. The rating is a route rating, non_traditional_rating, or
+    None for an unknown color.
+    """
+    # 2 and 0.5 come through here because some styles are missing color tags, but we still grab the
+    # first tag. Need to investigate why color tags are missing on these
+    color = style[0][0].text if len(style) and len(style[0]) else None
+
+    if color == str(non_traditional_color):
+        return color, non_traditional_rating
+    if color == str(hyp_color):
+        return color, hypothetical_rating
+    if color == str(would_consider_color):
+        return color, would_consider_rating
+    if color == str(color_3) or color == 'ff06ff21' or color == '2':
+        return color, 3  # Green #ff06ff21 is a slightly different green
+    if color == str(color_2) or color == '0.5':
+        return color, 2  # Yellow
+    if color == str(color_1):
+        return color, 1  # Red
+
+    return color, None
+
+
+def read_resident_folder(residentFolder, namespace, style_map_dict, street_blocks, style_nodes_dict,
+                         block_index=None, route_matches=None):
+    """Read the conversation and notes of one resident folder"""
+    print(' Reading conversation ' + residentFolder[0].text)
+    subFolder_mapping = {}
+    pass_through_nodes = []
+    notes = []
 
-    for residentFolder in residentFolders:
+    description = get_description(residentFolder, namespace)
+    walking_ability = get_walking_ability(description)
+    biking_ability = get_biking_ability(description)
+
+    for subFolder in sub_folders_xpath(residentFolder):
+        subFolderName = subFolder[0].text
+
+        if is_route_folder_name(subFolderName):
+
+            subFolder_mapping[subFolderName] = read_conversation_routes(subFolder, namespace, style_map_dict,
+                                                                        street_blocks, style_nodes_dict,
+                                                                        block_index, route_matches)
+        # elif subFolderName.lower() == hypotheticals_folder_name.lower():
+        # for subHypFolder in subFolder.xpath("./kml:Folder",
+        # namespaces=namespace):
+        #    subHypFolderName = subHypFolder[0].text
+        #    hyp_folder_key =
+        #    get_hypothetical_folder_key(subHypFolderName)
+
+        #    if subHypFolderName.lower() == walking_folder_name.lower()
+        #    or subHypFolderName.lower() == biking_folder_name.lower():
+        #        subFolder_mapping[hyp_folder_key] =
+        #        read_conversation_routes(subHypFolder, namespace,
+        #        style_map_dict, street_blocks, style_nodes_dict)
+        elif subFolderName.lower() == notes_folder_name.lower():
+            notes = read_notes(subFolder, namespace)
 
-        # if 'Ailin' not in residentFolder[0].text: continue
+        else:
+            pass_through_nodes.append(create_pass_through_folder(subFolder, style_nodes_dict, namespace))
 
-        print(' Reading conversation ' + residentFolder[0].text)
-        subFolder_mapping = {}
-        pass_through_nodes = []
-        notes = []
-
-        description = get_description(residentFolder, namespace)
-        walking_ability = get_walking_ability(description)
-        biking_ability = get_biking_ability(description)
-
-        for subFolder in residentFolder.xpath("./kml:Folder", namespaces=namespace):
-            subFolderName = subFolder[0].text
-
-            if subFolderName.lower() == walking_folder_name.lower() or \
-                    subFolderName.lower() == biking_folder_name.lower() or \
-                    subFolderName.lower() == hypotheticals_folder_name.lower():
-
-                subFolder_mapping[subFolderName] = read_conversation_routes(subFolder, namespace, style_map_dict,
-                                                                            street_blocks, style_nodes_dict)
-            # elif subFolderName.lower() == hypotheticals_folder_name.lower():
-            # for subHypFolder in subFolder.xpath("./kml:Folder",
-            # namespaces=namespace):
-            #    subHypFolderName = subHypFolder[0].text
-            #    hyp_folder_key =
-            #    get_hypothetical_folder_key(subHypFolderName)
-
-            #    if subHypFolderName.lower() == walking_folder_name.lower()
-            #    or subHypFolderName.lower() == biking_folder_name.lower():
-            #        subFolder_mapping[hyp_folder_key] =
-            #        read_conversation_routes(subHypFolder, namespace,
-            #        style_map_dict, street_blocks, style_nodes_dict)
-            elif subFolderName.lower() == notes_folder_name.lower():
-                notes = read_notes(subFolder, namespace)
+    return (Conversation(residentFolder[0].text, description, walking_ability, biking_ability, subFolder_mapping,
+                         pass_through_nodes), NoteBundle(notes))
 
-            else:
-                pass_through_nodes.append(create_pass_through_folder(subFolder, style_nodes_dict, namespace))
 
-        yield (Conversation(residentFolder[0].text, description, walking_ability, biking_ability, subFolder_mapping,
-                            pass_through_nodes), NoteBundle(notes))
+def is_route_folder_name(name):
+    """Whether a resident sub folder holds coded route folders"""
+    return name.lower() == walking_folder_name.lower() or \
+        name.lower() == biking_folder_name.lower() or \
+        name.lower() == hypotheticals_folder_name.lower()
+
+
+def read_route_coordinates(residentFolder):
+    """Coordinates of every line placemark read_conversation_routes may match, in document order"""
+    coordinates = []
+
+    for subFolder in sub_folders_xpath(residentFolder):
+        if not is_route_folder_name(subFolder[0].text):
+            continue
+
+        for placemark in route_placemarks_xpath(subFolder):
+            style_url, line_coordinates = placemark_style_url_and_coordinates(placemark)
+            if line_coordinates is not None:
+                coordinates.append(line_coordinates.text.strip())
+
+    return coordinates
 
 
 def get_walking_ability(description):
@@ -151,61 +324,96 @@ def get_biking_ability(description):
 
 
 def get_description(folder, namespace):
-    return folder.xpath("./kml:description", namespaces=namespace)[0].text
+    return description_xpath(folder)[0].text
+
 
+def read_conversation_routes(folder, namespace, style_map_dict, street_blocks, style_nodes_dict, block_index=None,
+                             route_matches=None):
+    """Read the coded folders of a route folder and match their routes to street blocks.
 
-def read_conversation_routes(folder, namespace, style_map_dict, street_blocks, style_nodes_dict):
+    route_matches optionally maps stripped coordinate text to the street blocks
+    already matched for it, e.g. by a process pool.
+    """
     coded_folders = []
 
-    for subFolder in folder.xpath("./kml:Folder", namespaces=namespace):
+    for subFolder in sub_folders_xpath(folder):
         code = subFolder[0].text
         # folder[0].text
         folders = []
         nontraditional = []
 
-        for placemark in subFolder.xpath('.//kml:Placemark', namespaces=namespace):
-            style_url = placemark.xpath('.//kml:styleUrl', namespaces=namespace)
-            coordinates = placemark.xpath('.//kml:LineString/kml:coordinates', namespaces=namespace)
-            color = style_map_dict[style_url[0].text][0][0].text
+        for placemark in placemarks_xpath(subFolder):
+            style_url, coordinates = placemark_style_url_and_coordinates(placemark)
+            color, rating = style_map_dict[style_url.text]
 
-            if coordinates:
-                if color == str(non_traditional_color):
+            if coordinates is not None:
+                if rating == non_traditional_rating:
                     nontraditional.append(create_pass_through_folder(placemark, style_nodes_dict, namespace))
-                else:  # 2 and 0.5 come through here because some styles are missing color tags, but we still grab the
-                    # first tag. Need to investigate why color tags are missing on these
-                    if color == str(hyp_color):
-                        rating = hypothetical_rating
-                    elif color == str(would_consider_color):
-                        rating = would_consider_rating
-                    elif color == str(color_3) or color == 'ff06ff21' or color == '2':
-                        rating = 3  # Green #ff06ff21 is a slightly different green
-                    elif color == str(color_2) or color == '0.5':
-                        rating = 2  # Yellow
-                    elif color == str(color_1):
-                        rating = 1  # Red
-                    else:
-                        print('WARN: Unknown color ' + color + ' in ' + folder[
+                else:
+                    if rating is None:
+                        print('WARN: Unknown color ' + str(color) + ' in ' + folder[
                             0].text + '/' + code + '. Skipping ...')
+                        counters['unknown_color_routes_skipped'] += 1
                         continue
 
-                    lines = list(populate_lines(coordinates[0].text.strip()))
-                    folders.append(ConversationRoute(rating, find_overlapping_streetblocks(street_blocks, lines)))
+                    coordinates_text = coordinates.text.strip()
+
+                    if route_matches is not None and coordinates_text in route_matches:
+                        route_blocks = route_matches[coordinates_text]
+                        counters['routes_reused'] += 1
+                    else:
+                        lines = LineArray(populate_segments(coordinates_text))
+                        route_blocks = find_overlapping_streetblocks(street_blocks, lines, block_index)
+
+                    folders.append(ConversationRoute(rating, route_blocks))
 
         coded_folders.append(ConversationCodedFolder(code, folders, nontraditional))
 
     return ConversationFolder(folder[0].text, coded_folders)
 
 
+def placemark_style_url_and_coordinates(placemark):
+    """First styleUrl and first LineString coordinates node of a placemark, found in one walk"""
+    style_url = None
+    coordinates = None
+
+    for node in placemark.iter(STYLE_URL, COORDINATES):
+        if node.tag == STYLE_URL:
+            if style_url is None:
+                style_url = node
+        elif coordinates is None and node.getparent().tag == LINE_STRING:
+            coordinates = node
+
+        if style_url is not None and coordinates is not None:
+            break
+
+    return style_url, coordinates
+
+
 def read_notes(folder, namespace):
     notes = []
-    for placemark in folder.xpath('.//kml:Placemark', namespaces=namespace):
+    for placemark in placemarks_xpath(folder):
         notes.append(placemark)
 
     return notes
 
 
-def find_overlapping_streetblocks(street_blocks, path_measure_lines):
+def find_overlapping_streetblocks(street_blocks, path_measure_lines, block_index=None):
+    """Find the street blocks a path crosses, in street block order.
+
+    block_index is an optional StreetBlockIndex or SegmentEngine built over the
+    same street blocks. It must give the same result as the loop below, which
+    stays as the reference implementation.
+    """
+    counters['routes_matched'] += 1
+
+    if block_index is not None:
+        return block_index.find_overlapping(path_measure_lines)
+
+    # Materialize Line views once rather than once per block
+    path_measure_lines = list(path_measure_lines)
     blocks = []
+    counters['blocks_scanned'] += len(street_blocks)
 
     for block in street_blocks:
         if is_block_overlapping(block, path_measure_lines):
@@ -215,11 +423,16 @@ def find_overlapping_streetblocks(street_blocks, path_measure_lines):
 
 
 def is_block_overlapping(block, path_measure_lines):
+    tests = 0
+
     for trigger_line in block.trigger_lines:
         for path_measure_line in path_measure_lines:
+            tests += 1
             if lines_cross(trigger_line, path_measure_line):
+                counters['intersection_tests'] += tests
                 return True
 
+    counters['intersection_tests'] += tests
     return False
 
 
@@ -285,35 +498,60 @@ def create_placemark(parent, name, line, styleId):
     append_node_with_text(line_string, "coordinates", str(line))
 
 
-def write_trigger_lines_kml(output_path, street_blocks):
+def write_kml_file(output_path, kml, pretty_print=True):
+    """Serialize a whole KML tree to a .kml or .kmz file"""
+    with open_kml_output(output_path) as generated_kml:
+        generated_kml.write('<?xml version="1.0" encoding="UTF-8"?>' '\n')
+        generated_kml.write(etree.tounicode(kml, pretty_print=pretty_print))
+
+
+def append_trigger_line_styles(document):
+    """Add the styles of the trigger lines KML"""
+    append_line_style(document, "purple", "FF00A5FF", 2)
+    append_line_style(document, "highlight", "ffaaaaaa", 2)
+    append_style_map(document, "StyleMap", "purple", "highlight")
+
+
+def write_trigger_lines_kml(output_path, street_blocks, stream=False, pretty_print=True):
     """Create a KML file with trigger lines"""
+    if stream:
+        write_trigger_lines_kml_stream(output_path, street_blocks, pretty_print)
+        return
+
     kml = etree.Element('kml', nsmap=get_kml_namespace())
     document = create_node(kml, "Document", "Trigger Lines")
     # folder = create_folder(document, "Trigger Lines")
 
     # Add styles
-    append_line_style(document, "purple", "FF00A5FF", 2)
-    append_line_style(document, "highlight", "ffaaaaaa", 2)
-    append_style_map(document, "StyleMap", "purple", "highlight")
+    append_trigger_line_styles(document)
 
     for block in street_blocks:
-        for trigger_line in block.trigger_lines:
+        for trigger_line in format_segments(block.trigger_segments):
             create_placemark(document, block.name, trigger_line, "StyleMap")
 
-    with open(output_path, 'w') as generated_kml:
+    write_kml_file(output_path, kml, pretty_print)
+
+
+def write_trigger_lines_kml_stream(output_path, street_blocks, pretty_print=True):
+    """Create a KML file with trigger lines, writing one block at a time"""
+    with open_kml_output(output_path) as generated_kml:
         generated_kml.write('<?xml version="1.0" encoding="UTF-8"?>' '\n')
-        generated_kml.write(etree.tounicode(kml, pretty_print=True))
-        generated_kml.close()
+        writer = KmlStreamWriter(generated_kml, 'kml', get_kml_namespace(), pretty_print)
 
+        writer.start("Document")
+        append_node_with_text(writer.container, "name", "Trigger Lines")
+        append_trigger_line_styles(writer.container)
 
-def write_final_kml(output_path, conversation_data, date):
-    """Create the final KML output file"""
-    kml = etree.Element('kml', nsmap=get_kml_namespace())
-    document = create_node(kml, "Document", "Final Python Output " + date.strftime("%m/%d/%y"))
-    conversations_folder = create_folder(document, "CONVERSATIONS")
-    compilations_folder = create_folder(document, "COMPILATIONS")
+        for block in street_blocks:
+            for trigger_line in format_segments(block.trigger_segments):
+                create_placemark(writer.container, block.name, trigger_line, "StyleMap")
+            writer.flush()
 
-    # Add styles
+        writer.close()
+
+
+def append_final_styles(document):
+    """Add the fixed styles of the final output"""
     append_line_style(document, "purple", "FFFF01EA", 2)
     append_line_style(document, "color_3", str(color_3), 2)
     append_line_style(document, "color_2", str(color_2), 2)
@@ -326,269 +564,407 @@ def write_final_kml(output_path, conversation_data, date):
     append_style_map(document, "ColorHyp", "color_hyp", "highlight")
     append_style_map(document, "Color-1", "purple", "highlight")
 
-    color_dict = {3.0: "Color3",
-                  2.0: "Color2",
-                  1.0: "Color1",
-                  hypothetical_rating: "ColorHyp",
-                  -1.0: "Color-1"}
 
-    for datum in conversation_data:
-        conversation = datum[0]
-        resident_notes = datum[1]
+def create_color_dict():
+    """Rating -> style map id for the fixed styles of the final output"""
+    return {3.0: "Color3",
+            2.0: "Color2",
+            1.0: "Color1",
+            hypothetical_rating: "ColorHyp",
+            -1.0: "Color-1"}
 
-        # Create one folder for each conversation
-        resident_folder = create_folder(conversations_folder, conversation.residentName)
 
-        append_node_with_text(resident_folder, "description", conversation.description)
+def write_final_kml(output_path, conversation_data, date, stream=False, pretty_print=True, merge_lines=False,
+                    gradient_steps=0):
+    """Create the final KML output file
 
-        hyp_folder = None
-        codes = {}
+    With merge_lines, each street block is written as one LineString instead
+    of one placemark per segment. With gradient_steps, a gradient
+    compilation of that many colors is added.
+    """
+    if stream:
+        write_final_kml_stream(output_path, conversation_data, date, pretty_print, merge_lines, gradient_steps)
+        return
 
-        # Add named conversation route groups
-        for route_folder_name, conversation_folder in conversation.conversation_folders.items():
-            route_folder_node = None
-
-            # Handle hypothetical differently
-            if hypotheticals_folder_name in route_folder_name:
-                if hyp_folder is None:
-                    hyp_folder = create_folder(resident_folder, hypotheticals_folder_name)
+    kml = etree.Element('kml', nsmap=get_kml_namespace())
+    document = create_node(kml, "Document", "Final Python Output " + date.strftime("%m/%d/%y"))
+    conversations_folder = create_folder(document, "CONVERSATIONS")
+    compilations_folder = create_folder(document, "COMPILATIONS")
 
-                for coded_folder in conversation_folder.coded_folders:
-                    hyp_lines = []
+    # Add styles
+    append_final_styles(document)
+    color_dict = create_color_dict()
 
-                    for route in coded_folder.routes:
-                        for block in route.street_blocks:
-                            for line in block.lines:
-                                if route.rating == hypothetical_rating:
-                                    hyp_lines.append([block.name, line])
-                                else:
-                                    print(block.name)
+    style_registry = StyleRegistry(is_output_style_id)
+    compilation = WalkingCompilation()
 
-                    create_rating_subfolder(hyp_lines, hyp_folder, coded_folder.code, color_dict[hypothetical_rating])
-            else:
-                for coded_folder in conversation_folder.coded_folders:
-
-                    # Find correct code folder
-                    if "GF" in coded_folder.code:
-                        if "GF" not in codes:
-                            # Create parent GF folder if it does not exist
-                            codes["GF"] = create_folder(resident_folder, "GF")
-                        # Create biking or walking subfolder within GF
-                        codes[coded_folder.code] = create_folder(codes["GF"], coded_folder.code)
-                    elif "GTD" in coded_folder.code:
-                        if "GTD" not in codes:
-                            # Create parent GTD folder if it does not exist
-                            codes["GTD"] = create_folder(resident_folder, "GTD")
-                        # Create biking or walking subfolder within GTD
-                        codes[coded_folder.code] = create_folder(codes["GTD"], coded_folder.code)
-
-                    coded_folder_node = codes[coded_folder.code]
+    for datum in conversation_data:
+        register_resident_styles(style_registry, datum[0])
+        create_resident_folder(conversations_folder, datum, color_dict, merge_lines)
+        compilation.add(datum)
 
-                    # Create category folders
-                    np_lines = []
-                    hm_lines = []
-                    nw_lines = []
+    # Copy over styles of nontraditional and pass through nodes, once each
+    for style in style_registry.elements():
+        document.append(style)
 
-                    for route in coded_folder.routes:
-                        for block in route.street_blocks:
-                            for line in block.lines:
-                                if route.rating == 1.0:
-                                    nw_lines.append([block.name, line])
-                                elif route.rating == 2.0:
-                                    hm_lines.append([block.name, line])
-                                elif route.rating == 3.0:
-                                    np_lines.append([block.name, line])
-                                else:
-                                    print(block.name)
+    compilation.write(document, compilations_folder, color_dict, merge_lines)
 
-                    # Only populate folders with children
-                    create_rating_subfolder(np_lines, coded_folder_node, "NP", color_dict[3.0])
-                    create_rating_subfolder(hm_lines, coded_folder_node, "HM", color_dict[2.0])
-                    create_rating_subfolder(nw_lines, coded_folder_node, "NW", color_dict[1.0])
+    if gradient_steps:
+        create_gradient_compilation(document, compilations_folder, compilation.aggregator.matrix, color_dict,
+                                    gradient_steps, merge_lines)
 
-                    # Copy over nontraditional nodes and styles
-                    if coded_folder.nontraditional != []:
-                        nt_folder = create_folder(coded_folder_node, "nontraditional")
-                        for nt in coded_folder.nontraditional:
-                            nt_folder.append(nt.folder_root)
+    write_kml_file(output_path, kml, pretty_print)
 
-                            for style in nt.styles:
-                                document.append(style)
 
-        # Add extra stuff (pass through nodes)
-        for pass_through in conversation.pass_through_nodes:
-            resident_folder.append(pass_through.folder_root)
+def write_final_kml_stream(output_path, conversation_data, date, pretty_print=True, merge_lines=False,
+                           gradient_steps=0):
+    """Create the final KML output file, writing each resident folder as soon as it is built.
 
-            for style in pass_through.styles:
-                document.append(style)
+    Gives the same bytes as write_final_kml. conversation_data may be a
+    generator still reading and matching residents; each resident is written
+    and counted into the compilations as it comes, and is not kept after.
+    """
+    conversation_data = iter(conversation_data)
+    color_dict = create_color_dict()
+    style_registry = StyleRegistry(is_output_style_id)
+    compilation = WalkingCompilation()
 
-        # Add notes folder
-        if resident_notes.notes:
-            notes_folder = create_folder(resident_folder, notes_folder_name)
-            for note in resident_notes.notes:
-                notes_folder.append(deepcopy(note))
+    # Copied styles bring their tails into the document, which stops libxml2
+    # indenting it; that has to be known before the document is opened. So
+    # residents are held back until one copies a style with a tail, or all
+    # have been read.
+    held_data = []
+    mixed = False
 
-    create_walking_compilation(document, compilations_folder, conversation_data, color_dict)
-    # create_gradient_compilation(document, compilations, conversations, color_dict)
+    for datum in conversation_data:
+        held_data.append(datum)
+        if has_tailed_styles(datum[0]):
+            mixed = True
+            break
 
-    with open(output_path, 'w') as generated_kml:
+    with open_kml_output(output_path) as generated_kml:
         generated_kml.write('<?xml version="1.0" encoding="UTF-8"?>' '\n')
-        generated_kml.write(etree.tounicode(kml, pretty_print=True))
-        generated_kml.close()
+        writer = KmlStreamWriter(generated_kml, 'kml', get_kml_namespace(), pretty_print)
 
+        writer.start("Document", mixed)
+        append_node_with_text(writer.container, "name", "Final Python Output " + date.strftime("%m/%d/%y"))
 
-def create_walking_compilation(document, compilations_folder, conversation_data, color_dict):
-    # top_level_folders = {}
+        writer.start("Folder")
+        append_node_with_text(writer.container, "name", "CONVERSATIONS")
 
-    folder_dict = {}
-    notes = []
+        def write_resident(datum):
+            register_resident_styles(style_registry, datum[0])
+            create_resident_folder(writer.container, datum, color_dict, merge_lines)
+            writer.flush()
+            compilation.add(datum)
 
-    for datum in conversation_data:
-        conversation = datum[0]
-        note_bundle = datum[1]
+        while held_data:
+            write_resident(held_data.pop(0))
 
-        for route_folder_name, conversation_folder in conversation.conversation_folders.items():
+        for datum in conversation_data:
+            write_resident(datum)
 
-            # if route_folder_name not in top_level_folders:
-            #    top_level_folders[route_folder_name] = create_folder(compilations, route_folder_name)
+        writer.end()
 
-            # top_level_folder = top_level_folders[route_folder_name]
+        # Compilations add their styles after all others
+        compilation_styles = etree.Element("Document")
+        compilations_folder = create_folder(writer.container, "COMPILATIONS")
+        compilation.write(compilation_styles, compilations_folder, color_dict, merge_lines)
+        if gradient_steps:
+            create_gradient_compilation(compilation_styles, compilations_folder, compilation.aggregator.matrix,
+                                        color_dict, gradient_steps, merge_lines)
+        writer.flush()
 
-            # Setup folder dictionary
-            if route_folder_name not in folder_dict:
-                folder_dict[route_folder_name] = {}
+        final_styles = etree.Element("Document")
+        append_final_styles(final_styles)
+        writer.write(list(final_styles))
+        writer.write(style_registry.elements())
+        writer.write(list(compilation_styles))
 
-            ability_dict = folder_dict[route_folder_name]
+        writer.close()
 
-            # Setup ability dictionary
-            if route_folder_name == walking_folder_name:
-                ability_dict_key = conversation.walking_ability
-            elif route_folder_name == biking_folder_name:
-                ability_dict_key = conversation.biking_ability
-            elif route_folder_name == hypotheticals_folder_name:
-                ability_dict_key = ''
 
-            if ability_dict_key not in ability_dict:
-                ability_dict[ability_dict_key] = {}
+def create_resident_folder(parent, datum, color_dict, merge_lines=False):
+    """Create the output folder of one resident"""
+    conversation = datum[0]
+    resident_notes = datum[1]
 
-            coding_dict = ability_dict[ability_dict_key]
+    # Create one folder for each conversation
+    resident_folder = create_folder(parent, conversation.residentName)
 
-            for coded_folder in conversation_folder.coded_folders:
-                if coded_folder.code not in coding_dict:
-                    coding_dict[coded_folder.code] = {}
+    append_node_with_text(resident_folder, "description", conversation.description)
 
-                block_dict = coding_dict[coded_folder.code]
+    hyp_folder = None
+    codes = {}
 
-                for route in coded_folder.routes:
-                    if route.rating < 0:
-                        continue
+    # Add named conversation route groups
+    for route_folder_name, conversation_folder in conversation.conversation_folders.items():
+        route_folder_node = None
 
-                    for block in route.street_blocks:
-                        if block in block_dict:
-                            block_dict[block].append(route.rating)
-                        else:
-                            block_dict[block] = [route.rating]
+        # Handle hypothetical differently
+        if hypotheticals_folder_name in route_folder_name:
+            if hyp_folder is None:
+                hyp_folder = create_folder(resident_folder, hypotheticals_folder_name)
 
-            for note in note_bundle.notes:
-                notes.append(note)
-
-    # process codes in a custom order
-    def folderSort(val):
-        if val == walking_folder_name: return 0
-        if val == biking_folder_name: return 1
-        if val == hypotheticals_folder_name: return 2
-        return 100
-
-    def abilitySort(val):
-        if val[0] == 'BNCRC': return 0
-        if val[0] == 'BNAAS': return 1
-        if val[0] == 'wCB': return 2
-        if val[0] == 'WNOS': return 3
-        if val[0] == 'WNSSS': return 4
-        if val[0] == 'wCw': return 5
-        return 100
-
-    # for code in sorted(rating_dict.keys(), key = customSort):
-    for folder_name in sorted(folder_dict.keys(), key=folderSort):
-        ability_dict = folder_dict[folder_name]
-
-        if folder_name == walking_folder_name:
-            for ability, purposes in ability_dict.items():
-                tmp = {}
-                for purpose, blocks in purposes.items():
-                    for block, nums in blocks.items():
-                        tmp.update({deepcopy(block): nums})
-                purposes.update({"eitherW": tmp})
-            new_folder_name = "walking"
-        elif folder_name == biking_folder_name:
-            for ability, purposes in ability_dict.items():
-                tmp = {}
-                for purpose, blocks in purposes.items():
-                    for block, nums in blocks.items():
-                        tmp.update({deepcopy(block): nums})
-                purposes.update({"eitherB": tmp})
-            new_folder_name = "biking"
-        else:
-            new_folder_name = folder_name
+            for coded_folder in conversation_folder.coded_folders:
+                hyp_lines = []
 
-        top_level_folder = create_folder(compilations_folder, new_folder_name)
+                for route in coded_folder.routes:
+                    for block in route.street_blocks:
+                        for line in block_lines(block, merge_lines):
+                            if route.rating == hypothetical_rating:
+                                hyp_lines.append([block.name, line])
+                            else:
+                                print(block.name)
 
-        for ability, code_dict in sorted(ability_dict.items(), key=abilitySort):
-            if folder_name == hypotheticals_folder_name:
-                ability_folder = top_level_folder
-            else:
-                ability_folder = create_folder(top_level_folder, ability)
+                create_rating_subfolder(hyp_lines, hyp_folder, coded_folder.code, color_dict[hypothetical_rating])
+        else:
+            for coded_folder in conversation_folder.coded_folders:
 
-            for code, block_dict in code_dict.items():
-                code_folder = create_folder(ability_folder, code)
+                # Find correct code folder
+                if "GF" in coded_folder.code:
+                    if "GF" not in codes:
+                        # Create parent GF folder if it does not exist
+                        codes["GF"] = create_folder(resident_folder, "GF")
+                    # Create biking or walking subfolder within GF
+                    codes[coded_folder.code] = create_folder(codes["GF"], coded_folder.code)
+                elif "GTD" in coded_folder.code:
+                    if "GTD" not in codes:
+                        # Create parent GTD folder if it does not exist
+                        codes["GTD"] = create_folder(resident_folder, "GTD")
+                    # Create biking or walking subfolder within GTD
+                    codes[coded_folder.code] = create_folder(codes["GTD"], coded_folder.code)
+
+                coded_folder_node = codes[coded_folder.code]
 
                 # Create category folders
                 np_lines = []
                 hm_lines = []
                 nw_lines = []
-                hyp_lines = []
 
-                for block, ratings in block_dict.items():
-                    rating = calculate_rating(ratings, ability)
-                    color = get_color_string(rating)
-
-                    if color not in color_dict:
-                        append_line_style(document, "color_" + color, color, 2)
-                        append_style_map(document, "Color-" + color, "color_" + color, "highlight")
-                        color_dict[color] = "Color-" + color
-
-                    for line in block.lines:
-                        if rating == 1.0:
-                            nw_lines.append([block.name, line])
-                        elif rating == 2.0:
-                            hm_lines.append([block.name, line])
-                        elif rating == 3.0:
-                            np_lines.append([block.name, line])
-                        elif rating == hypothetical_rating:
-                            hyp_lines.append([block.name, line])
-                        else:
-                            print(block.name)
+                for route in coded_folder.routes:
+                    for block in route.street_blocks:
+                        for line in block_lines(block, merge_lines):
+                            if route.rating == 1.0:
+                                nw_lines.append([block.name, line])
+                            elif route.rating == 2.0:
+                                hm_lines.append([block.name, line])
+                            elif route.rating == 3.0:
+                                np_lines.append([block.name, line])
+                            else:
+                                print(block.name)
 
                 # Only populate folders with children
-                create_rating_subfolder(np_lines, code_folder, "NP", color_dict[3.0])
-                create_rating_subfolder(hm_lines, code_folder, "HM", color_dict[2.0])
-                create_rating_subfolder(nw_lines, code_folder, "NW", color_dict[1.0])
+                create_rating_subfolder(np_lines, coded_folder_node, "NP", color_dict[3.0])
+                create_rating_subfolder(hm_lines, coded_folder_node, "HM", color_dict[2.0])
+                create_rating_subfolder(nw_lines, coded_folder_node, "NW", color_dict[1.0])
 
-                # Populate Hypothetical street blocks
-                for name, line in hyp_lines:
-                    create_placemark(code_folder, name, line, color_dict[color])
+                # Copy over nontraditional nodes
+                if coded_folder.nontraditional != []:
+                    nt_folder = create_folder(coded_folder_node, "nontraditional")
+                    for nt in coded_folder.nontraditional:
+                        nt_folder.append(nt.folder_root)
 
-    # Add Notes to notes folder
-    notes_folder = create_folder(compilations_folder, "Notes")
-    avoided_ints_folder = create_folder(notes_folder, "Avoided Intersections")
+    # Add extra stuff (pass through nodes)
+    for pass_through in conversation.pass_through_nodes:
+        resident_folder.append(pass_through.folder_root)
 
-    for note in notes:
-        note_name = note.xpath('.//kml:name/text()', namespaces=get_kml_namespace())
+    # Add notes folder
+    if resident_notes.notes:
+        notes_folder = create_folder(resident_folder, notes_folder_name)
+        for note in resident_notes.notes:
+            notes_folder.append(deepcopy(note))
 
-        if note_name and ("Avoided Intersection" in note_name[0] or "Bad Intersection" in note_name[0]):
-            avoided_ints_folder.append(note)
-        else:
-            notes_folder.append(note)
+
+def register_resident_styles(style_registry, conversation):
+    """Register the styles of a resident's nontraditional and pass through nodes.
+
+    Their styleUrls are pointed at the registered styles, so this has to run
+    before the nodes are written.
+    """
+    for pass_through in resident_pass_through_folders(conversation):
+        rewrite_style_urls(pass_through.folder_root, style_registry.register_all(pass_through.styles))
+
+
+def resident_pass_through_folders(conversation):
+    """A resident's nontraditional and pass through nodes that go to the output, in output order"""
+    pass_through_folders = []
+
+    for route_folder_name, conversation_folder in conversation.conversation_folders.items():
+        if hypotheticals_folder_name in route_folder_name:
+            continue
+
+        for coded_folder in conversation_folder.coded_folders:
+            pass_through_folders.extend(coded_folder.nontraditional)
+
+    pass_through_folders.extend(conversation.pass_through_nodes)
+
+    return pass_through_folders
+
+
+def has_tailed_styles(conversation):
+    """Whether a resident copies a style with a tail to the output"""
+    return any(style.tail for pass_through in resident_pass_through_folders(conversation)
+               for style in pass_through.styles)
+
+
+# Ids of the styles created for colors of compiled ratings, see get_color_string
+output_color_style_id = re.compile(r'(color_|Color-)[0-9a-f]{8}$')
+
+
+def is_output_style_id(style_id):
+    """Whether the final output creates a style with this id itself"""
+    return style_id in ("purple", "highlight", "color_3", "color_2", "color_1", "color_hyp",
+                        "Color3", "Color2", "Color1", "ColorHyp", "Color-1") or \
+        output_color_style_id.match(style_id) is not None
+
+
+def create_walking_compilation(document, compilations_folder, conversation_data, color_dict, merge_lines=False):
+    compilation = WalkingCompilation()
+
+    for datum in conversation_data:
+        compilation.add(datum)
+
+    compilation.write(document, compilations_folder, color_dict, merge_lines)
+
+
+class WalkingCompilation(object):
+    """Ratings and notes of the residents added so far, written out as the compilation folders.
+
+    Residents can be added as they are read, so they need not all be kept
+    until the compilations are written.
+    """
+
+    def __init__(self):
+        self.aggregator = RatingAggregator(calculate_rating)
+        self.notes = []
+        # Carried over from one route folder to the next, as route folders
+        # with other names reuse the last ability
+        self.ability_dict_key = None
+
+    def add(self, datum):
+        """Count the ratings of one resident and collect its notes"""
+        # top_level_folders = {}
+
+        conversation = datum[0]
+        note_bundle = datum[1]
+
+        for route_folder_name, conversation_folder in conversation.conversation_folders.items():
+
+            # if route_folder_name not in top_level_folders:
+            #    top_level_folders[route_folder_name] = create_folder(compilations, route_folder_name)
+
+            # top_level_folder = top_level_folders[route_folder_name]
+
+            # Setup ability key
+            if route_folder_name == walking_folder_name:
+                self.ability_dict_key = conversation.walking_ability
+            elif route_folder_name == biking_folder_name:
+                self.ability_dict_key = conversation.biking_ability
+            elif route_folder_name == hypotheticals_folder_name:
+                self.ability_dict_key = ''
+
+            # Count the ratings of every block per ability and code
+            self.aggregator.add(route_folder_name, self.ability_dict_key, conversation_folder.coded_folders,
+                                conversation.residentName)
+
+            for note in note_bundle.notes:
+                self.notes.append(note)
+
+    def write(self, document, compilations_folder, color_dict, merge_lines=False):
+        """Create the compilation folders in compilations_folder, and their styles in document"""
+        aggregator = self.aggregator
+        notes = self.notes
+
+        # process codes in a custom order
+        def folderSort(val):
+            if val == walking_folder_name: return 0
+            if val == biking_folder_name: return 1
+            if val == hypotheticals_folder_name: return 2
+            return 100
+
+        def abilitySort(val):
+            if val[0] == 'BNCRC': return 0
+            if val[0] == 'BNAAS': return 1
+            if val[0] == 'wCB': return 2
+            if val[0] == 'WNOS': return 3
+            if val[0] == 'WNSSS': return 4
+            if val[0] == 'wCw': return 5
+            return 100
+
+        # for code in sorted(rating_dict.keys(), key = customSort):
+        for folder_name in sorted(aggregator.folders.keys(), key=folderSort):
+            ability_dict = aggregator.folders[folder_name]
+
+            # Walking and biking get an extra code rolling up the blocks of all codes
+            if folder_name == walking_folder_name:
+                rollup_code = "eitherW"
+                new_folder_name = "walking"
+            elif folder_name == biking_folder_name:
+                rollup_code = "eitherB"
+                new_folder_name = "biking"
+            else:
+                rollup_code = None
+                new_folder_name = folder_name
+
+            top_level_folder = create_folder(compilations_folder, new_folder_name)
+
+            for ability, code_dict in sorted(ability_dict.items(), key=abilitySort):
+                if folder_name == hypotheticals_folder_name:
+                    ability_folder = top_level_folder
+                else:
+                    ability_folder = create_folder(top_level_folder, ability)
+
+                for code, block_ids, ratings in aggregator.code_ratings(code_dict, ability, rollup_code):
+                    code_folder = create_folder(ability_folder, code)
+
+                    # Create category folders
+                    np_lines = []
+                    hm_lines = []
+                    nw_lines = []
+                    hyp_lines = []
+
+                    for block_id, rating in zip(block_ids, ratings):
+                        block = aggregator.blocks[block_id]
+                        color = get_color_string(rating)
+
+                        if color not in color_dict:
+                            append_line_style(document, "color_" + color, color, 2)
+                            append_style_map(document, "Color-" + color, "color_" + color, "highlight")
+                            color_dict[color] = "Color-" + color
+
+                        for line in block_lines(block, merge_lines):
+                            if rating == 1.0:
+                                nw_lines.append([block.name, line])
+                            elif rating == 2.0:
+                                hm_lines.append([block.name, line])
+                            elif rating == 3.0:
+                                np_lines.append([block.name, line])
+                            elif rating == hypothetical_rating:
+                                hyp_lines.append([block.name, line])
+                            else:
+                                print(block.name)
+
+                    # Only populate folders with children
+                    create_rating_subfolder(np_lines, code_folder, "NP", color_dict[3.0])
+                    create_rating_subfolder(hm_lines, code_folder, "HM", color_dict[2.0])
+                    create_rating_subfolder(nw_lines, code_folder, "NW", color_dict[1.0])
+
+                    # Populate Hypothetical street blocks
+                    for name, line in hyp_lines:
+                        create_placemark(code_folder, name, line, color_dict[color])
+
+        # Add Notes to notes folder
+        notes_folder = create_folder(compilations_folder, "Notes")
+        avoided_ints_folder = create_folder(notes_folder, "Avoided Intersections")
+
+        for note in notes:
+            note_name = name_text_xpath(note)
+
+            if note_name and ("Avoided Intersection" in note_name[0] or "Bad Intersection" in note_name[0]):
+                avoided_ints_folder.append(note)
+            else:
+                notes_folder.append(note)
 
 
 def calculate_rating(ratings, code):
@@ -626,40 +1002,52 @@ def compute_mode(numbers):
     return modes
 
 
-def create_gradient_compilation(document, compilations, conversations, color_dict):
-    gradient_folder = create_folder(compilations, "Gradients")
+def create_gradient_compilation(document, compilations_folder, matrix, color_dict, steps, merge_lines=False):
+    """Color every rated street block by its mean rating from 1 to 3, over all residents and codes.
 
-    rating_sum = {}
-    rating_count = {}
+    matrix is the RatingMatrix of the walking compilation. Mean ratings are
+    rounded to one of steps evenly spaced ratings, so at most steps styles
+    are added to document.
+    """
+    gradient_folder = create_folder(compilations_folder, "Gradients")
 
-    for conversation in conversations:
-        for route_folder_name, route_folder in conversation.route_groups.items():
-            for route in route_folder.routes:
-                if route.rating < 0:
-                    continue
+    means = matrix.block_stats(ratings=(1.0, 2.0, 3.0))['mean']
+    block_ids = np.flatnonzero(~np.isnan(means))
+    step_ids = np.clip(np.rint((means[block_ids] - 1.0) / 2.0 * (steps - 1)), 0, steps - 1).astype(np.intp)
 
-                for block in route.street_blocks:
-                    if block in rating_sum:
-                        rating_sum[block] += route.rating
-                    else:
-                        rating_sum[block] = route.rating
-
-                    if block in rating_count:
-                        rating_count[block] += 1
-                    else:
-                        rating_count[block] = 1
+    step_ratings = np.linspace(1.0, 3.0, steps).tolist()
+    style_ids = [None] * steps
 
-    for block in rating_sum.keys():
-        rating = rating_sum[block] / rating_count[block]
+    for step in sorted(set(step_ids.tolist())):
+        rating = step_ratings[step]
         color = get_color_string(rating)
 
+        if rating in color_dict:
+            style_ids[step] = color_dict[rating]
+            continue
+
         if color not in color_dict:
             append_line_style(document, "color_" + color, color, 2)
             append_style_map(document, "Color-" + color, "color_" + color, "highlight")
             color_dict[color] = "Color-" + color
+        style_ids[step] = color_dict[color]
+
+    for block_id, step in zip(block_ids.tolist(), step_ids.tolist()):
+        block = matrix.blocks[block_id]
+
+        for line in block_lines(block, merge_lines):
+            create_placemark(gradient_folder, block.name, line, style_ids[step])
+
+
+def block_lines(block, merge_lines=False):
+    """Coordinates text to write for a street block: each segment, or with merge_lines the whole block"""
+    if not merge_lines:
+        return block.segment_coordinates()
+
+    if len(block.vertices) < 2:
+        return []
 
-        for line in block.lines:
-            create_placemark(gradient_folder, block.name, line, color_dict[color])
+    return [format_coordinates(block.vertices)]
 
 
 def create_rating_subfolder(lines, parent_folder, folder_name, styleId):